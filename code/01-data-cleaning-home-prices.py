@@ -11,134 +11,204 @@
 # Import Libraries and Config
 # -----------------------------------------------------------------------------
 import os
-import re
-import sys
+import argparse
+from datetime import datetime
 import pandas as pd
 import geopandas as gpd
 import matplotlib.pyplot as plt
 
-# Run central config file to reference project directories - if you're running
-# this interactively, uncomment below and set wd to code directory 
-
-sys.path.append(r"C:\Users\macka\github-repos\water-quality-home-prices\code")
-
+# If running interactively, set the working directory to the code directory
 import config
-
-# -----------------------------------------------------------------------------
-# Load Home Price Data
-# -----------------------------------------------------------------------------
-zillow_file = os.path.join(
-    config.RAW_HOME_PRICE_DIR,
-    "Zip_zhvi_uc_sfrcondo_tier_0.33_0.67_sm_sa_month.csv"
-)
-
-zip_data = pd.read_csv(zillow_file)
-print(f"Total rows read: {len(zip_data):,}")
-
-# -----------------------------------------------------------------------------
-# Filter for California Only
-# -----------------------------------------------------------------------------
-ca_zip_data = zip_data[zip_data["State"] == "CA"].copy()
-n_unique_zips = ca_zip_data["RegionName"].nunique()
-print(f"Number of unique CA zip codes in Zillow data: {n_unique_zips:,}")
-
-# -----------------------------------------------------------------------------
-# Reshape Data (Wide -> Long)
-# -----------------------------------------------------------------------------
-# Identify columns that begin with digits (i.e., date columns)
-date_cols = [c for c in ca_zip_data.columns if re.match(r'^\d', c)]
-
-ca_zip_data_long = ca_zip_data.melt(
-    id_vars=[col for col in ca_zip_data.columns if col not in date_cols],
-    value_vars=date_cols,
-    var_name="Date",
-    value_name="Value"
-)
-
-# Convert Date strings to datetime (adjust format if necessary)
-ca_zip_data_long["Date"] = pd.to_datetime(
-    ca_zip_data_long["Date"],
-    format="%Y-%m-%d",
-    errors="coerce"
-)
-
-print("Long data shape:", ca_zip_data_long.shape)
-
-# -----------------------------------------------------------------------------
-# Check for Balanced Panel and Missing Values
-# -----------------------------------------------------------------------------
-ca_zip_data_long["n_rows"] = (
-    ca_zip_data_long.groupby("RegionName")["RegionName"].transform("size")
+from storage import write_table, read_table, append_partition, table_paths
+from panel_diagnostics import wide_panel_diagnostics
+from zillow_reshape import (
+    home_price_panel_name, zhvi_date_columns, reshape_zhvi_chunk, write_zhvi_panel,
+    read_zhvi_delta
 )
-
-ca_zip_data_long["n_missing_rows"] = (
-    ca_zip_data_long.groupby("RegionName")["Value"].transform(lambda x: x.isna().sum())
-)
-
-print("\nSummary of 'n_rows' per zip code:")
-print(ca_zip_data_long["n_rows"].describe())
-
-print("\nSummary of 'n_missing_rows' per zip code:")
-print(ca_zip_data_long["n_missing_rows"].describe())
-
-# -----------------------------------------------------------------------------
-# Final Data Cleaning (Year/Month Columns, Rename, Select)
-# -----------------------------------------------------------------------------
-ca_zip_data_long["year"] = ca_zip_data_long["Date"].dt.year
-ca_zip_data_long["month"] = ca_zip_data_long["Date"].dt.month
-
-# Rename columns to mimic your R approach
-ca_zip_data_long.rename(
-    columns={
-        "RegionName":  "zip_code",
-        "CountyName":  "county_name",
-        "Value":       "avg_home_price"
-    },
-    inplace=True
-)
-
-# Rename all columns to lowercase
-ca_zip_data_long.columns = [col.lower() for col in ca_zip_data_long.columns]
-
-# Keep only relevant columns
-CA_home_price_panel = ca_zip_data_long[
-    ["zip_code", "city", "metro", "county_name", "date", "avg_home_price", "year", "month"]
-].copy()
-
-# -----------------------------------------------------------------------------
-# Save Final Data
-# -----------------------------------------------------------------------------
-output_file = os.path.join(config.PROCESSED_DATA_DIR, "CA_home_price_panel.csv")
-CA_home_price_panel.to_csv(output_file, index=False)
-print(f"\nFinal cleaned dataset saved to:\n{output_file}")
-
-# -----------------------------------------------------------------------------
-# Reload and Summaries
-# -----------------------------------------------------------------------------
-# If you want to confirm the saved file loads properly:
-# Highlight these lines in VS Code to run them
-test_df = pd.read_csv(output_file, parse_dates=["date"])
-print("Reloaded dataset shape:", test_df.shape)
-print(test_df.head(3))
-
-# -----------------------------------------------------------------------------
-# Geographic Check Using GeoPandas (Example)
-# -----------------------------------------------------------------------------
-# If you have a shapefile of CA ZIP codes, you might do:
-# shape_file = os.path.join(config.RAW_CWS_DIR, "ca_zcta10.shp")  # Example name
-# zip_shapes = gpd.read_file(shape_file)
-# print("Shapefile loaded with", len(zip_shapes), "rows.")
-
-# # Plot a quick map
-# zip_shapes.plot()
-# plt.title("California Zip Codes from Shapefile")
-# plt.show()
-
-# # Compare zip codes:
-# all_ca_zips = zip_shapes["ZCTA5CE10"].astype(str).unique()
-# zillow_zips = test_df["zip_code"].astype(str).unique()
-# missing_zips = set(all_ca_zips) - set(zillow_zips)
-# print("\nZip codes in shapefile but missing in Zillow data:")
-# print(missing_zips)
-
-print("\nScript finished.")
+from instrumentation import RunReport
+from keys import normalize_zip, zcta_keys
+
+
+def parse_args(argv=None):
+    """Command-line options of the script (`argv` defaults to sys.argv)."""
+    # Append the months of a new Zillow release to the existing panel instead of
+    # rebuilding it (config default, or --append)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--append", action="store_true", default=config.PANEL_APPEND)
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def main(argv=None):
+    """
+    Build the home price panel, or append a new Zillow release to it. `argv`
+    holds command-line options as for the script (defaults to sys.argv).
+    """
+    args = parse_args(argv)
+
+    # Timing, memory and row counts for each step, saved as a JSON run report
+    report = RunReport("home-prices")
+
+    # -------------------------------------------------------------------------
+    # Load Home Price Data
+    # -------------------------------------------------------------------------
+    zillow_file = os.path.join(
+        config.RAW_HOME_PRICE_DIR,
+        "Zip_zhvi_uc_sfrcondo_tier_0.33_0.67_sm_sa_month.csv"
+    )
+
+    panel_name = home_price_panel_name(config.ZILLOW_STATES)
+
+    # Months and zips already in the panel, to find what this release adds
+    append = args.append and os.path.exists(table_paths(panel_name)[0])
+    if append:
+        report.start("load-previous")
+        previous_panel = read_table(panel_name, columns=["zip_code", "date"])
+        report.stop(rows_out=len(previous_panel))
+
+        report.start("delta")
+        panel_delta, new_dates, new_zips, dropped_zips = read_zhvi_delta(
+            zillow_file,
+            states=config.ZILLOW_STATES,
+            known_dates=previous_panel["date"].unique(),
+            known_zips=previous_panel["zip_code"].unique()
+        )
+        report.stop(rows_out=len(panel_delta))
+
+        if len(dropped_zips):
+            print(f"{len(dropped_zips)} zips are no longer in the Zillow file, rebuilding the panel")
+            append = False
+
+    if append:
+        # Save only the new months (and history of new zips) as a new partition
+        print(f"New months: {len(new_dates)}, new zips: {len(new_zips)}")
+        report.start("write", rows_in=len(panel_delta))
+        if len(panel_delta):
+            append_partition(
+                panel_delta,
+                panel_name,
+                partition=datetime.now().strftime("%Y%m%d-%H%M%S"),
+                key=["date", "zip_code"]
+            )
+        report.stop()
+        print(f"Appended {len(panel_delta):,} panel rows")
+        output_file = table_paths(panel_name)[0]
+        zip_coverage = None
+
+    elif config.ZILLOW_STREAMING:
+        # Read, filter and reshape the file in chunks of zips, appending each chunk
+        # to the output so that only one chunk is held in memory at a time
+        report.start("stream")
+        output_file, n_rows, zip_coverage = write_zhvi_panel(
+            zillow_file,
+            states=config.ZILLOW_STATES,
+            chunksize=config.ZILLOW_CHUNKSIZE
+        )
+        report.stop(rows_out=n_rows)
+        print(f"Streamed {n_rows:,} panel rows")
+
+    else:
+        report.start("load")
+        zip_data = pd.read_csv(zillow_file)
+        report.stop(rows_out=len(zip_data))
+        print(f"Total rows read: {len(zip_data):,}")
+
+        # ---------------------------------------------------------------------
+        # Filter for Selected States (California Only by Default)
+        # ---------------------------------------------------------------------
+        report.start("filter", rows_in=len(zip_data))
+        if config.ZILLOW_STATES is not None:
+            zip_data = zip_data[zip_data["State"].isin(config.ZILLOW_STATES)]
+        report.stop(rows_out=len(zip_data))
+        n_unique_zips = zip_data["RegionName"].nunique()
+        print(f"Number of unique zip codes in Zillow data: {n_unique_zips:,}")
+
+        # ---------------------------------------------------------------------
+        # Reshape Data (Wide -> Long)
+        # ---------------------------------------------------------------------
+        # Identify columns that begin with digits (i.e., date columns) and parse
+        # them to datetimes once, then reshape keeping only the ID columns we use
+        date_cols = zhvi_date_columns(zip_data.columns)
+        dates = pd.to_datetime(pd.Index(date_cols), format="%Y-%m-%d", errors="coerce")
+
+        # Per-zip coverage of the wide price matrix (months observed, missing, gaps)
+        report.start("diagnostics", rows_in=len(zip_data))
+        zip_coverage = wide_panel_diagnostics(
+            zip_data[date_cols], normalize_zip(zip_data["RegionName"]), dates, "zip_code"
+        )
+        report.stop(rows_out=len(zip_coverage))
+
+        # Zips are keyed with the shared ZCTA key dictionary as they are reshaped
+        report.start("reshape", rows_in=len(zip_data))
+        CA_home_price_panel = reshape_zhvi_chunk(
+            zip_data,
+            date_cols,
+            dates,
+            keep_state=config.ZILLOW_STATES is None or len(config.ZILLOW_STATES) > 1,
+            keys=zcta_keys()
+        )
+        report.stop(rows_out=len(CA_home_price_panel))
+
+        print("Long data shape:", CA_home_price_panel.shape)
+
+        # ---------------------------------------------------------------------
+        # Save Final Data
+        # ---------------------------------------------------------------------
+        report.start("write", rows_in=len(CA_home_price_panel))
+        output_file = write_table(CA_home_price_panel, panel_name)
+        report.stop()
+
+    # -------------------------------------------------------------------------
+    # Check for Balanced Panel and Missing Values
+    # -------------------------------------------------------------------------
+    # Coverage is only summarized for full builds, which see the whole history
+    if zip_coverage is not None:
+        print("\nSummary of months per zip code:")
+        print(zip_coverage["n_periods"].describe())
+
+        print("\nSummary of missing months per zip code:")
+        print(zip_coverage["n_missing"].describe())
+
+        print("\nSummary of gaps between first and last observed month per zip code:")
+        print(zip_coverage["n_gaps"].describe())
+
+    print(f"\nFinal cleaned dataset saved to:\n{output_file}")
+
+    # -------------------------------------------------------------------------
+    # Reload and Summaries
+    # -------------------------------------------------------------------------
+    # If you want to confirm the saved file loads properly:
+    # Highlight these lines in VS Code to run them. Streamed and appended panels
+    # are not reloaded, as that would hold the whole panel in memory at once
+    if not append and not config.ZILLOW_STREAMING:
+        test_df = read_table(panel_name, parse_dates=["date"])
+        print("Reloaded dataset shape:", test_df.shape)
+        print(test_df.head(3))
+
+    # -------------------------------------------------------------------------
+    # Geographic Check Using GeoPandas (Example)
+    # -------------------------------------------------------------------------
+    # If you have a shapefile of CA ZIP codes, you might do:
+    # shape_file = os.path.join(config.RAW_CWS_DIR, "ca_zcta10.shp")  # Example name
+    # zip_shapes = gpd.read_file(shape_file)
+    # print("Shapefile loaded with", len(zip_shapes), "rows.")
+
+    # # Plot a quick map
+    # zip_shapes.plot()
+    # plt.title("California Zip Codes from Shapefile")
+    # plt.show()
+
+    # # Compare zip codes:
+    # all_ca_zips = zip_shapes["ZCTA5CE10"].astype(str).unique()
+    # zillow_zips = test_df["zip_code"].astype(str).unique()
+    # missing_zips = set(all_ca_zips) - set(zillow_zips)
+    # print("\nZip codes in shapefile but missing in Zillow data:")
+    # print(missing_zips)
+
+    report.write()
+
+    print("\nScript finished.")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,198 +12,288 @@
 # Import Libraries and Config
 # -----------------------------------------------------------------------------
 import os
-import sys
-import pandas as pd
-import geopandas as gpd
+import json
+import argparse
 import matplotlib.pyplot as plt
 import numpy as np
 from pathlib import Path
 
-# Run central config file to reference project directories
-# If running interactively, uncomment & set working directory to code directory
-sys.path.append(r"C:\Users\macka\github-repos\water-quality-home-prices\code")
-
+# If running interactively, set the working directory to the code directory
 import config
+from crosswalk import (
+    build_crosswalks, crosswalk_state, update_crosswalks, simplify_layer, count_vertices,
+    compare_crosswalks, fast_mode_suffix
+)
+from storage import (
+    read_table, write_table, read_geo_table, write_geo_table, table_paths,
+    geo_table_paths, processed_path
+)
+from spatial_cache import load_layer
+from violation_indicators import indicator_names
+from instrumentation import RunReport
+from keys import normalize_pws_id, encode_pws, encode_zcta
 
-# -----------------------------------------------------------------------------
-# Loading PWS Boundary System Data
-# -----------------------------------------------------------------------------
-print("Loading PWS boundary data...")
 
-# Load shapefile data
-pws_sf = gpd.read_file(os.path.join(
-    config.RAW_CWS_DIR,
-    "California_Drinking_Water_System_Area_Boundaries.shp"
-))
+def parse_args(argv=None):
+    """Command-line options of the script (`argv` defaults to sys.argv)."""
+    # Number of overlay worker processes (config default, or --workers N),
+    # whether to update the previous crosswalks instead of rebuilding them, and
+    # the fast-mode simplification tolerance / grid size (meters)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=config.CROSSWALK_N_WORKERS)
+    parser.add_argument("--incremental", action="store_true", default=config.CROSSWALK_INCREMENTAL)
+    parser.add_argument("--simplify", type=float, default=config.CROSSWALK_SIMPLIFY_TOLERANCE)
+    parser.add_argument("--grid-size", type=float, default=config.CROSSWALK_GRID_SIZE)
+    parser.add_argument("--check-fast", action="store_true")
+    args, _ = parser.parse_known_args(argv)
+    return args
 
-# Check for duplicated rows in the PWS data
-duplicates = pws_sf.groupby("SABL_PWSID").size().reset_index(name='n')
-duplicates = duplicates[duplicates['n'] > 1]
-print(f"Found {len(duplicates)} PWS IDs with multiple polygons")
 
-# -----------------------------------------------------------------------------
-# Load Violations Panel to Identify Systems of Interest
-# -----------------------------------------------------------------------------
-print("Loading violations panel data...")
+def main(argv=None):
+    """
+    Build (or update) the PWS to ZTCA crosswalks for both ZTCA vintages. `argv`
+    holds command-line options as for the script (defaults to sys.argv).
+    """
+    args = parse_args(argv)
 
-# Load violations panel data
-panel_data = pd.read_csv(os.path.join(
-    config.PROCESSED_DATA_DIR,
-    "CA_monthly_violation_panel.csv"
-))
+    # Timing, memory and row counts for each step, saved as a JSON run report
+    report = RunReport("mapping")
 
-# Identify systems with violations
-PWS_with_violation_IDs = panel_data[
-    (panel_data["tier1_all"] == 1) | 
-    (panel_data["arsenic"] == 1) | 
-    (panel_data["dbcp"] == 1)
-]["PWS ID"].unique()
+    # -------------------------------------------------------------------------
+    # Loading PWS Boundary System Data
+    # -------------------------------------------------------------------------
+    print("Loading PWS boundary data...")
 
-print(f"Found {len(PWS_with_violation_IDs)} water systems with violations")
+    # Load shapefile data, reprojected to the California equal-area projection
+    # (EPSG:3310). The reprojected layers are cached, so only the first run on
+    # a given version of each shapefile parses and reprojects it
+    report.start("load")
+    report.start("pws")
+    pws_sf = load_layer(os.path.join(
+        config.RAW_CWS_DIR,
+        "California_Drinking_Water_System_Area_Boundaries.shp"
+    ), crs="EPSG:3310").to_geodataframe()
+    report.stop(rows_out=len(pws_sf))
 
-# Create a subset of PWS data with only systems that have violations
-pws_with_violations = pws_sf[pws_sf["SABL_PWSID"].isin(PWS_with_violation_IDs)].copy()
+    # Normalize system IDs and key them with the shared integer dictionary used
+    # by the violations panel
+    pws_sf["SABL_PWSID"] = normalize_pws_id(pws_sf["SABL_PWSID"])
+    pws_sf["pws_key"] = encode_pws(pws_sf["SABL_PWSID"])
 
-# Check for duplicate systems in the filtered data
-pws_with_violations_multiples = pws_with_violations.groupby("SABL_PWSID").size().reset_index(name='n')
-pws_with_violations_multiples = pws_with_violations_multiples[pws_with_violations_multiples['n'] > 1]
-print(f"Systems with multiple polygons in filtered data: {len(pws_with_violations_multiples)}")
+    # Check for duplicated rows in the PWS data
+    duplicates = pws_sf.groupby("SABL_PWSID").size().reset_index(name='n')
+    duplicates = duplicates[duplicates['n'] > 1]
+    print(f"Found {len(duplicates)} PWS IDs with multiple polygons")
 
-# -----------------------------------------------------------------------------
-# Loading ZTCA Boundary Data
-# -----------------------------------------------------------------------------
-print("Loading ZTCA boundary data (2000 and 2010)...")
-
-# Load the ZCTA shapefiles from your directory structure
-# Using the exact paths from your screenshots
-ztca_shapes_00 = gpd.read_file(os.path.join(
-    config.RAW_DATA_DIR, 
-    "ZCTA-census-boundaries",
-    "ZCTA-2000",
-    "tl_2010_06_zcta500.shp"
-))
-
-ztca_shapes_10 = gpd.read_file(os.path.join(
-    config.RAW_DATA_DIR, 
-    "ZCTA-census-boundaries",
-    "ZCTA-2010",
-    "tl_2010_06_zcta510.shp"
-))
-
-print(f"Loaded {len(ztca_shapes_00)} ZCTAs from 2000")
-print(f"Loaded {len(ztca_shapes_10)} ZCTAs from 2010")
-
-# Make sure CRS match for spatial operations
-# Set CRS to equal-area projection for California using EPSG:3310
-pws_with_violations = pws_with_violations.to_crs(epsg=3310)
-ztca_equal_area = ztca_shapes_00.to_crs(epsg=3310)
-
-# Calculate area of each ZTCA and store in square meters
-ztca_equal_area["zcta_area_m2"] = ztca_equal_area.geometry.area
-
-# Save a separate non-GeoDataFrame object list with each ZTCA + its area in meters
-# Make sure to use the correct column name based on your shapefile
-# For 2000 ZCTAs, the ZIP code column appears to be "ZCTA5CE00"
-ztca_area = ztca_equal_area[["ZCTA5CE00", "zcta_area_m2"]].copy()
-ztca_area = pd.DataFrame(ztca_area.drop(columns="geometry"))
-
-# Now, deal with water systems where we had multiple rows in PWS data
-# Group by PWS ID and use union to combine geometries
-pws_with_violations = pws_with_violations.dissolve(by="SABL_PWSID", aggfunc="first").reset_index()
-
-# Calculate area of each PWS in square meters
-pws_with_violations["pws_area_m2"] = pws_with_violations.geometry.area
+    # -------------------------------------------------------------------------
+    # Load Violations Panel to Identify Systems of Interest
+    # -------------------------------------------------------------------------
+    print("Loading violations panel data...")
 
-# -----------------------------------------------------------------------------
-# Spatial Overlay of PWS and ZTCA Boundaries
-# -----------------------------------------------------------------------------
-print("Performing spatial overlay (this will take some time)...")
-
-output = []
-output_sf = []
-
-for i, pws_index in enumerate(PWS_with_violation_IDs):
-    print(f"Running Spatial Overlay for CWS {i+1} of {len(PWS_with_violation_IDs)}: {pws_index}")
-    
-    # Filter for current PWS
-    pws_poly = pws_with_violations[pws_with_violations["SABL_PWSID"] == pws_index]
-    
-    if pws_poly.empty:
-        print(f"No geometry found for PWS ID {pws_index}, skipping...")
-        continue
-    
-    # Find ZTCAs that intersect with this PWS
-    # This is more efficient than checking all ZTCAs
-    spatial_index = ztca_equal_area.sindex
-    possible_matches_index = list(spatial_index.intersection(pws_poly.iloc[0].geometry.bounds))
-    possible_matches = ztca_equal_area.iloc[possible_matches_index]
-    
-    if len(possible_matches) == 0:
-        # Handle case with no intersections
-        output.append(pd.DataFrame({
-            "SABL_PWSID": [pws_index],
-            "intersect_area_m2": [0],
-            "ZCTA5CE00": [None],
-            "zcta_area_m2": [None],
-            "coverage_frac_ztca": [0]
-        }))
-        print(f"No ZTCA intersections found for CWS {i+1} ({pws_index})")
-        continue
-    
-    # Now, use intersection to measure spatial overlap
-    actual_intersects = possible_matches[possible_matches.intersects(pws_poly.iloc[0].geometry)]
-    
-    if len(actual_intersects) == 0:
-        # Double-check that there really are no intersections
-        output.append(pd.DataFrame({
-            "SABL_PWSID": [pws_index],
-            "intersect_area_m2": [0],
-            "ZCTA5CE00": [None],
-            "zcta_area_m2": [None],
-            "coverage_frac_ztca": [0]
-        }))
-        continue
-    
-    # Calculate intersection
-    overlap = gpd.overlay(pws_poly, actual_intersects, how='intersection')
-    
-    # Export GeoDataFrame for plotting and visual checks
-    output_sf.append(overlap[["SABL_PWSID", "ZCTA5CE00", "geometry"]])
-    
-    # Create area column for each overlap polygon
-    overlap["intersect_area_m2"] = overlap.geometry.area
-    
-    # Convert to DataFrame and join with ZTCA area data
-    overlap_df = overlap[["SABL_PWSID", "intersect_area_m2", "ZCTA5CE00"]].copy()
-    overlap_df = pd.DataFrame(overlap_df.drop(columns="geometry"))
-    
-    # Join with ZTCA area information and calculate coverage fraction
-    overlap_df = overlap_df.merge(ztca_area, on="ZCTA5CE00", how="left")
-    overlap_df["coverage_frac_ztca"] = overlap_df["intersect_area_m2"] / overlap_df["zcta_area_m2"]
-    
-    output.append(overlap_df)
-
-# Combine all results
-if output:
-    pws_zcta_overlay = pd.concat(output, ignore_index=True)
-else:
-    pws_zcta_overlay = pd.DataFrame(columns=["SABL_PWSID", "intersect_area_m2", "ZCTA5CE00", "zcta_area_m2", "coverage_frac_ztca"])
-
-if output_sf:
-    output_sf_combined = pd.concat(output_sf, ignore_index=True)
-    output_sf_combined = gpd.GeoDataFrame(output_sf_combined, geometry="geometry")
-else:
-    output_sf_combined = gpd.GeoDataFrame(columns=["SABL_PWSID", "ZCTA5CE00", "geometry"], geometry="geometry")
-
-# Save crosswalk file of PWS to ZTCA + GeoDataFrame version of spatial data
-pws_zcta_overlay.to_csv(os.path.join(
-    config.PROCESSED_DATA_DIR, 
-    "CA-PWS-to-ZTCA-2000-crosswalk.csv"
-), index=False)
-
-output_sf_combined.to_file(os.path.join(
-    config.PROCESSED_DATA_DIR,
-    "CA-PWS-to-ZTCA-2000-crosswalk-SF.geojson"
-), driver="GeoJSON")
-
-print("Crosswalk files created and saved.")
\ No newline at end of file
+    # Load the system-months with any of the crosswalk's violation indicators
+    # in config (only the system key, filtered in the read)
+    report.start("violations-panel")
+    unknown = set(config.CROSSWALK_INDICATORS) - set(indicator_names(config.VIOLATION_INDICATOR_RULES))
+    if unknown:
+        raise ValueError(f"CROSSWALK_INDICATORS not in VIOLATION_INDICATOR_RULES: {sorted(unknown)}")
+    panel_data = read_table(
+        "CA_monthly_violation_panel",
+        columns=["pws_key"],
+        filters=[[(col, "==", 1)] for col in config.CROSSWALK_INDICATORS]
+    )
+    report.stop(rows_out=len(panel_data))
+
+    # Identify systems with violations (by integer system key)
+    PWS_with_violation_keys = panel_data["pws_key"].unique()
+
+    print(f"Found {len(PWS_with_violation_keys)} water systems with violations")
+
+    # Create a subset of PWS data with only systems that have violations, or keep
+    # every system if a statewide crosswalk is requested in config
+    if config.CROSSWALK_ALL_PWS:
+        PWS_with_violation_keys = pws_sf["pws_key"].unique()
+
+    pws_with_violations = pws_sf[pws_sf["pws_key"].isin(PWS_with_violation_keys)].copy()
+
+    # Check for duplicate systems in the filtered data
+    pws_with_violations_multiples = pws_with_violations.groupby("SABL_PWSID").size().reset_index(name='n')
+    pws_with_violations_multiples = pws_with_violations_multiples[pws_with_violations_multiples['n'] > 1]
+    print(f"Systems with multiple polygons in filtered data: {len(pws_with_violations_multiples)}")
+
+    # -------------------------------------------------------------------------
+    # Loading ZTCA Boundary Data
+    # -------------------------------------------------------------------------
+    print("Loading ZTCA boundary data (2000 and 2010)...")
+
+    # ZCTA vintages to crosswalk: shapefile and ZCTA ID column for each
+    ZTCA_VINTAGES = {
+        "2000": (os.path.join("ZCTA-2000", "tl_2010_06_zcta500.shp"), "ZCTA5CE00"),
+        "2010": (os.path.join("ZCTA-2010", "tl_2010_06_zcta510.shp"), "ZCTA5CE10"),
+    }
+
+    # Load the ZCTA shapefiles from your directory structure, as memory-mapped
+    # cached layers whose spatial index is built once and shared with workers
+    report.start("zcta")
+    ztca_shapes = {
+        vintage: load_layer(
+            os.path.join(config.RAW_DATA_DIR, "ZCTA-census-boundaries", shp), crs="EPSG:3310"
+        )
+        for vintage, (shp, _) in ZTCA_VINTAGES.items()
+    }
+    report.stop(rows_out=sum(len(shapes) for shapes in ztca_shapes.values()))
+    report.stop()
+
+    for vintage, shapes in ztca_shapes.items():
+        print(f"Loaded {len(shapes)} ZCTAs from {vintage}")
+
+    # All layers are already in the equal-area projection for California
+    # (EPSG:3310), so they can be intersected directly
+    report.start("prepare", rows_in=len(pws_with_violations))
+    ztca_layers = {
+        vintage: (ztca_shapes[vintage], id_col)
+        for vintage, (_, id_col) in ZTCA_VINTAGES.items()
+    }
+
+    # Now, deal with water systems where we had multiple rows in PWS data
+    # Group by PWS ID and use union to combine geometries
+    pws_with_violations = pws_with_violations.dissolve(by="SABL_PWSID", aggfunc="first").reset_index()
+
+    # Calculate area of each PWS in square meters
+    pws_with_violations["pws_area_m2"] = pws_with_violations.geometry.area
+    report.stop(rows_out=len(pws_with_violations))
+
+    # Fast mode: intersect simplified / grid-snapped copies of the polygons. Area
+    # shares don't need survey-grade vertex density, and most of the overlay time
+    # goes into polygons with tens of thousands of vertices
+    fast_mode = args.simplify > 0 or args.grid_size > 0
+    exact_pws, exact_layers = pws_with_violations, ztca_layers
+    if fast_mode:
+        report.start("simplify")
+        pws_with_violations = simplify_layer(exact_pws, args.simplify, args.grid_size)
+        ztca_layers = {
+            vintage: (simplify_layer(shapes, args.simplify, args.grid_size), id_col)
+            for vintage, (shapes, id_col) in exact_layers.items()
+        }
+        report.stop(rows_out=len(pws_with_violations))
+
+        n_before = count_vertices(exact_pws) + sum(count_vertices(l) for l, _ in exact_layers.values())
+        n_after = count_vertices(pws_with_violations) + sum(count_vertices(l) for l, _ in ztca_layers.values())
+        print(f"Fast mode (simplify {args.simplify} m, grid {args.grid_size} m): "
+              f"{n_before:,} -> {n_after:,} vertices")
+
+    # -------------------------------------------------------------------------
+    # Spatial Overlay of PWS and ZTCA Boundaries
+    # -------------------------------------------------------------------------
+    print("Performing spatial overlay (this will take some time)...")
+
+    # Fast-mode crosswalks are saved under their own names, so an exploratory
+    # run never replaces the exact crosswalks used by the exposure stage
+    suffix = fast_mode_suffix(args.simplify, args.grid_size)
+
+    # Digests of each PWS geometry and ZTCA layer used for the previous crosswalks
+    state_path = processed_path(f"CA-PWS-to-ZTCA-crosswalk{suffix}-state", "json")
+
+    # Load the previous crosswalks, if any, for an incremental update
+    previous = {}
+    if args.incremental and os.path.exists(state_path):
+        with open(state_path) as f:
+            previous_state = json.load(f)
+        for vintage in ZTCA_VINTAGES:
+            name = f"CA-PWS-to-ZTCA-{vintage}-crosswalk{suffix}"
+            if os.path.exists(table_paths(name)[0]) and os.path.exists(geo_table_paths(name + "-SF")[0]):
+                previous[vintage] = (read_table(name), read_geo_table(name + "-SF"))
+
+    # Intersect all systems with both ZTCA vintages in one batched pass, sharing
+    # the PWS geometry preparation, sharded across worker processes if more
+    # than one worker is configured. In incremental mode, only systems that are
+    # new or whose boundaries changed since the previous run are intersected.
+    report.start("overlay", rows_in=len(pws_with_violations))
+    if previous:
+        crosswalks, state, n_recomputed = update_crosswalks(
+            pws_with_violations,
+            ztca_layers,
+            previous,
+            previous_state,
+            n_workers=args.workers,
+            pws_id_col="SABL_PWSID"
+        )
+        print(f"Incremental update: recomputed {n_recomputed} of {len(pws_with_violations)} systems")
+    else:
+        crosswalks = build_crosswalks(
+            pws_with_violations,
+            ztca_layers,
+            n_workers=args.workers,
+            pws_id_col="SABL_PWSID"
+        )
+        state = crosswalk_state(pws_with_violations, ztca_layers, "SABL_PWSID")
+    overlay_span = report.stop(rows_out=sum(len(crosswalk) for crosswalk, _ in crosswalks.values()))
+
+    # Error of the fast-mode crosswalks against an exact overlay, saved with the
+    # time each took so accuracy can be traded against speed
+    if fast_mode and args.check_fast:
+        report.start("exact-check", rows_in=len(exact_pws))
+        exact_crosswalks = build_crosswalks(
+            exact_pws, exact_layers, n_workers=args.workers, pws_id_col="SABL_PWSID"
+        )
+        exact_span = report.stop()
+
+        fast_mode_report = {
+            "simplify_tolerance_m": args.simplify,
+            "grid_size_m": args.grid_size,
+            "fast_overlay_s": overlay_span["wall_s"],
+            "exact_overlay_s": exact_span["wall_s"],
+            "vintages": {},
+        }
+        for vintage, (exact_crosswalk, _) in exact_crosswalks.items():
+            _, summary = compare_crosswalks(
+                exact_crosswalk, crosswalks[vintage][0], ZTCA_VINTAGES[vintage][1]
+            )
+            fast_mode_report["vintages"][vintage] = summary
+            print(f"{vintage}: coverage_frac_ztca error vs exact: "
+                  f"mean {summary['mean_abs_error']:.2e}, p99 {summary['p99_abs_error']:.2e}, "
+                  f"max {summary['max_abs_error']:.2e} "
+                  f"({summary['n_pairs_only_exact']} pairs lost, {summary['n_pairs_only_fast']} added)")
+
+        os.makedirs(config.OUTPUT_OTHR_DIR, exist_ok=True)
+        fast_mode_path = os.path.join(config.OUTPUT_OTHR_DIR, "crosswalk-fast-mode-error.json")
+        with open(fast_mode_path, "w") as f:
+            json.dump(fast_mode_report, f, indent=2)
+        print(f"Fast overlay {overlay_span['wall_s']:,.1f}s vs exact {exact_span['wall_s']:,.1f}s, "
+              f"error report saved to {fast_mode_path}")
+
+    n_no_geometry = len(np.setdiff1d(PWS_with_violation_keys, pws_with_violations["pws_key"]))
+    print(f"No geometry found for {n_no_geometry} PWS IDs, skipped")
+
+    # Save crosswalk file of PWS to ZTCA + GeoDataFrame version of spatial data
+    report.start("write")
+
+    # Remove the digests until every file is written, so an interrupted write
+    # leads to a full rebuild rather than an update of mismatched files
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    for vintage, (pws_zcta_overlay, output_sf_combined) in crosswalks.items():
+        id_col = ZTCA_VINTAGES[vintage][1]
+        print(f"{vintage}: no ZTCA intersections found for "
+              f"{pws_zcta_overlay[id_col].isna().sum()} CWS")
+        print(f"{vintage}: crosswalk rows: {len(pws_zcta_overlay):,}")
+
+        # Integer system and ZCTA keys for joining with the other panels
+        pws_zcta_overlay["pws_key"] = encode_pws(pws_zcta_overlay["SABL_PWSID"], add=False)
+        pws_zcta_overlay["zcta_key"] = encode_zcta(pws_zcta_overlay[id_col])
+
+        write_table(pws_zcta_overlay, f"CA-PWS-to-ZTCA-{vintage}-crosswalk{suffix}")
+        write_geo_table(output_sf_combined, f"CA-PWS-to-ZTCA-{vintage}-crosswalk{suffix}-SF")
+
+    # Save the digests of this run's inputs for the next incremental update
+    with open(state_path, "w") as f:
+        json.dump(state, f)
+    report.stop()
+
+    print("Crosswalk files created and saved.")
+
+    report.write()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,148 +13,310 @@
 # Import Libraries and Config
 # -----------------------------------------------------------------------------
 import os
-import sys
+import json
+import argparse
 import pandas as pd
 import numpy as np
 from datetime import datetime
 import re
 from pathlib import Path
 
-# If running interactively, uncomment & set working directory to code directory
-sys.path.append(r"C:\Users\macka\github-repos\water-quality-home-prices\code")
-
+# If running interactively, set the working directory to the code directory
 import config
-
-# -----------------------------------------------------------------------------
-# Load and Subset Raw Violations Data
-# -----------------------------------------------------------------------------
-# Load raw data from EPA
-violations_file = os.path.join(
-    config.RAW_EPA_DIR,
-    "Violation Report_20250308.xlsx"
+from panel_utils import (
+    expand_to_monthly, expand_flags_to_monthly, densify_panel, record_digests, diff_records
 )
+from storage import write_table, read_table, append_partition, table_paths, processed_path
+from panel_diagnostics import long_panel_diagnostics
+from sdwis_ingest import load_violation_report
+from violation_indicators import indicator_names, violation_flags, unpack_flags
+from instrumentation import RunReport
+from keys import normalize_pws_id, encode_pws, pws_keys
 
-# Skip the first 4 rows as they contain header information
-violations_raw = pd.read_excel(violations_file, skiprows=4)
 
-print(f"Total raw violations loaded: {len(violations_raw):,}")
+def parse_args(argv=None):
+    """Command-line options of the script (`argv` defaults to sys.argv)."""
+    # Update the existing panel with only the new and changed violations of a
+    # new SDWIS download instead of rebuilding it (config default, or --append)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--append", action="store_true", default=config.PANEL_APPEND)
+    args, _ = parser.parse_known_args(argv)
+    return args
 
-# Initial filtering and cleaning
-violations = violations_raw[
-    (violations_raw["PWS Type Code"] == "CWS") & 
-    (violations_raw["Public Notification Tier"].isin([1, 2])) &
-    (violations_raw["Compliance Status"] != "Open")
-].copy()
 
-# Convert population served to numeric, removing commas
-violations["population_served"] = violations["Population Served Count"].str.replace(",", "").astype(float)
+def main(argv=None):
+    """
+    Build the monthly violations panel, or update it from a new SDWIS download.
+    `argv` holds command-line options as for the script (defaults to sys.argv).
+    """
+    args = parse_args(argv)
 
-# Convert date columns
-violations["compliance_begin"] = pd.to_datetime(violations["Compliance Period Begin Date"])
-violations["compliance_end"] = pd.to_datetime(violations["Compliance Period End Date"])
-violations["rtc_end"] = pd.to_datetime(violations["RTC Date"])
+    # Timing, memory and row counts for each step, saved as a JSON run report
+    report = RunReport("violations")
 
-# Use coalesce equivalent in pandas (first non-null value)
-violations["end_date"] = violations["compliance_end"].fillna(violations["rtc_end"])
+    panel_name = "CA_monthly_violation_panel"
+    records_name = "CA_monthly_violation_panel-records"
+    indicators_path = processed_path("CA_monthly_violation_panel-indicators", "json")
 
-# Filter for CWS with population > 500
-violations = violations[violations["population_served"] > 500].copy()
+    # -------------------------------------------------------------------------
+    # Load and Subset Raw Violations Data
+    # -------------------------------------------------------------------------
+    # Load raw data from EPA
+    violations_file = os.path.join(
+        config.RAW_EPA_DIR,
+        "Violation Report_20250308.xlsx"
+    )
 
-print(f"Filtered violations: {len(violations):,}")
+    # Load the columns we use for closed tier 1/2 violations at community water
+    # systems (converted once from Excel and cached as Parquet)
+    report.start("load")
+    violations = load_violation_report(violations_file)
+    report.stop(rows_out=len(violations))
 
-# -----------------------------------------------------------------------------
-# Create Monthly-Level Violations Measures
-# -----------------------------------------------------------------------------
-# Filter to ensure start date is before end date
-violations = violations[violations["compliance_begin"] <= violations["end_date"]].copy()
-
-# Function to expand a violation record to monthly observations
-def expand_to_monthly(row):
-    # Floor dates to the beginning of the month
-    start_date = pd.Timestamp(row["compliance_begin"]).floor("M")
-    end_date = pd.Timestamp(row["end_date"]).floor("M")
-    
-    # Generate sequence of months
-    months = pd.date_range(start=start_date, end=end_date, freq="MS")
-    
-    # Create one row per month
-    monthly_rows = []
-    for month in months:
-        monthly_row = row.copy()
-        monthly_row["month"] = month
-        monthly_rows.append(monthly_row)
-    
-    return pd.DataFrame(monthly_rows)
-
-# Apply the function to each row and concatenate results
-violations_list = []
-for idx, row in violations.iterrows():
-    monthly_rows = expand_to_monthly(row)
-    violations_list.append(monthly_rows)
-
-violations_monthly = pd.concat(violations_list, ignore_index=True)
-print(f"Total monthly violation records: {len(violations_monthly):,}")
-
-# Create violation indicators
-violations_monthly["arsenic"] = (violations_monthly["Contaminant Name"] == "Arsenic").astype(int)
-violations_monthly["dbcp"] = (violations_monthly["Contaminant Name"] == "1,2-DIBROMO-3-CHLOROPROPANE").astype(int)
-violations_monthly["nitrate"] = violations_monthly["Contaminant Name"].isin(["Nitrate", "Nitrate-Nitrite"]).astype(int)
-violations_monthly["tier1_all"] = (violations_monthly["Public Notification Tier"] == 1).astype(int)
-violations_monthly["tier1_other"] = np.where(violations_monthly["nitrate"] == 1, 0, violations_monthly["tier1_all"])
-
-# Aggregate to PWS ID and month level
-violations_monthly_indicators = violations_monthly.groupby(["PWS ID", "month"]).agg({
-    "arsenic": "max",
-    "nitrate": "max",
-    "dbcp": "max",
-    "tier1_all": "max",
-    "tier1_other": "max"
-}).reset_index()
-
-# Check resulting coding
-print("\nViolations counts by type:")
-for col in ["arsenic", "nitrate", "dbcp", "tier1_all", "tier1_other"]:
-    count = violations_monthly_indicators[col].sum()
-    print(f"{col}: {count:,}")
+    print(f"CWS tier 1/2 closed violations loaded: {len(violations):,}")
 
-# -----------------------------------------------------------------------------
-# Generate PWS Panel
-# -----------------------------------------------------------------------------
-# Get unique PWS IDs and date range
-unique_pws_ids = violations["PWS ID"].unique()
-min_date = violations_monthly_indicators["month"].min()
-max_date = violations_monthly_indicators["month"].max()
-
-# Create date range
-date_range = pd.date_range(start=min_date, end=max_date, freq="MS")
-
-# Create full panel with all combinations
-pws_dates = [(pws_id, date) for pws_id in unique_pws_ids for date in date_range]
-panel_data = pd.DataFrame(pws_dates, columns=["PWS ID", "month"])
-
-# Merge with violations data
-panel_data = panel_data.merge(
-    violations_monthly_indicators,
-    on=["PWS ID", "month"],
-    how="left"
-)
+    report.start("filter", rows_in=len(violations))
 
-# Replace NAs with zeros
-for col in ["arsenic", "dbcp", "nitrate", "tier1_all", "tier1_other"]:
-    panel_data[col] = panel_data[col].fillna(0)
+    # Convert population served to numeric, removing commas
+    violations["population_served"] = violations["Population Served Count"].str.replace(",", "").astype(float)
 
-# Extract year and month
-panel_data["year"] = panel_data["month"].dt.year
-panel_data["month_num"] = panel_data["month"].dt.month
+    # Convert date columns
+    violations["compliance_begin"] = pd.to_datetime(violations["Compliance Period Begin Date"])
+    violations["compliance_end"] = pd.to_datetime(violations["Compliance Period End Date"])
+    violations["rtc_end"] = pd.to_datetime(violations["RTC Date"])
 
-# Sort the data
-panel_data = panel_data.sort_values(["PWS ID", "month"])
+    # Use coalesce equivalent in pandas (first non-null value)
+    violations["end_date"] = violations["compliance_end"].fillna(violations["rtc_end"])
 
-print(f"Panel data shape: {panel_data.shape}")
+    # Filter for CWS with population > 500
+    violations = violations[violations["population_served"] > 500].copy()
 
-# -----------------------------------------------------------------------------
-# Save Final Data
-# -----------------------------------------------------------------------------
-output_file = os.path.join(config.PROCESSED_DATA_DIR, "CA_monthly_violation_panel.csv")
-panel_data.to_csv(output_file, index=False)
-print(f"\nFinal panel dataset saved to:\n{output_file}")
\ No newline at end of file
+    print(f"Filtered violations: {len(violations):,}")
+
+    # -------------------------------------------------------------------------
+    # Create Monthly-Level Violations Measures
+    # -------------------------------------------------------------------------
+    # Filter to ensure start date is before end date
+    violations = violations[violations["compliance_begin"] <= violations["end_date"]].copy()
+    report.stop(rows_out=len(violations))
+
+    # Normalize system IDs and key them with the shared integer dictionary, so
+    # the steps below group and match on int32 keys instead of strings
+    violations["PWS ID"] = normalize_pws_id(violations["PWS ID"])
+    violations["pws_key"] = encode_pws(violations["PWS ID"])
+
+    # Panel extent: every system with a violation and every month covered
+    unique_pws_keys = np.sort(violations["pws_key"].unique())
+    date_range = pd.date_range(
+        start=violations["compliance_begin"].min().to_period("M").to_timestamp(),
+        end=violations["end_date"].max().to_period("M").to_timestamp(),
+        freq="MS"
+    )
+
+    # Indicator flags of each violation (one bit per indicator) from the rule
+    # table in config, applied once per violation before expanding to months
+    report.start("indicators", rows_in=len(violations))
+    indicator_cols = indicator_names(config.VIOLATION_INDICATOR_RULES)
+    violations["indicator_flags"] = violation_flags(violations, config.VIOLATION_INDICATOR_RULES)
+    report.stop(rows_out=int((violations["indicator_flags"] != 0).sum()))
+
+    # Hash the fields the indicators depend on, so the next SDWIS download can
+    # be compared with this one record by record. Including the flags means an
+    # edited rule shows up as changed records too
+    record_cols = [
+        "PWS ID", "Contaminant Name", "Public Notification Tier", "compliance_begin", "end_date",
+        "indicator_flags",
+    ]
+    violations["record_digest"] = record_digests(violations, record_cols)
+
+    # -------------------------------------------------------------------------
+    # Find New and Changed Violations (Append Mode)
+    # -------------------------------------------------------------------------
+    append = (
+        args.append
+        and os.path.exists(table_paths(panel_name)[0])
+        and os.path.exists(table_paths(records_name)[0])
+        and os.path.exists(indicators_path)
+    )
+
+    # A panel with other indicator columns (rules added, removed or renamed)
+    # has to be rebuilt
+    if append:
+        with open(indicators_path) as f:
+            if json.load(f) != indicator_cols:
+                print("Violation indicators changed, rebuilding the panel")
+                append = False
+    if append:
+        report.start("diff", rows_in=len(violations))
+        previous_records = read_table(records_name, parse_dates=["compliance_begin", "end_date"])
+        added, removed = diff_records(violations, previous_records)
+
+        previous_pws_keys = np.sort(previous_records["pws_key"].unique())
+        previous_range = pd.date_range(
+            start=previous_records["compliance_begin"].min().to_period("M").to_timestamp(),
+            end=previous_records["end_date"].max().to_period("M").to_timestamp(),
+            freq="MS"
+        )
+        report.stop(rows_out=len(added) + len(removed))
+        print(f"Violations added or changed: {len(added):,}, removed or changed: {len(removed):,}")
+
+        # A panel that would lose systems or months has to be rebuilt
+        if (np.setdiff1d(previous_pws_keys, unique_pws_keys).size
+                or previous_range.difference(date_range).size):
+            print("Systems or months dropped out of the violations data, rebuilding the panel")
+            append = False
+
+    if append:
+        new_pws_keys = np.setdiff1d(unique_pws_keys, previous_pws_keys)
+        new_months = date_range.difference(previous_range)
+
+        # Existing panel cells covered by an added or removed violation
+        changed_cells = expand_to_monthly(
+            pd.concat([added, removed])[["pws_key", "compliance_begin", "end_date"]],
+            start_col="compliance_begin",
+            end_col="end_date",
+            columns=["pws_key"]
+        ).drop_duplicates()
+        changed_cells = changed_cells[
+            changed_cells["pws_key"].isin(previous_pws_keys) &
+            changed_cells["month"].isin(previous_range)
+        ]
+
+        # Only the violations needed to recompute those cells, the new systems
+        # and the new months are expanded below
+        violations_to_expand = violations[
+            violations["pws_key"].isin(changed_cells["pws_key"]) |
+            violations["pws_key"].isin(new_pws_keys) |
+            (violations["compliance_begin"] < previous_range[0]) |
+            (violations["end_date"] >= previous_range[-1] + pd.offsets.MonthBegin(1))
+        ]
+        print(f"Changed panel cells: {len(changed_cells):,}, new systems: {len(new_pws_keys):,}, "
+              f"new months: {len(new_months):,}")
+    else:
+        violations_to_expand = violations
+
+    # Expand each flagged violation to the months it covers and OR the flags of
+    # all violations of a system in the same month, in one pass. Violations
+    # that set no indicator can't change any cell, so they are skipped
+    report.start("expand", rows_in=len(violations_to_expand))
+    monthly_flags = expand_flags_to_monthly(
+        violations_to_expand[violations_to_expand["indicator_flags"] != 0],
+        entity_col="pws_key",
+        start_col="compliance_begin",
+        end_col="end_date",
+        flag_col="indicator_flags"
+    )
+    report.stop(rows_out=len(monthly_flags))
+    print(f"System-months with a flagged violation: {len(monthly_flags):,}")
+
+    # Unpack to one int8 column per indicator. This sparse table only holds
+    # months with a flagged violation
+    violations_monthly_indicators = pd.concat([
+        monthly_flags[["pws_key", "month"]],
+        unpack_flags(monthly_flags["indicator_flags"], indicator_cols),
+    ], axis=1)
+
+    # Check resulting coding
+    if not append:
+        print("\nViolations counts by type:")
+        for col in indicator_cols:
+            count = violations_monthly_indicators[col].sum()
+            print(f"{col}: {count:,}")
+
+    # -------------------------------------------------------------------------
+    # Generate PWS Panel
+    # -------------------------------------------------------------------------
+    report.start("panel", rows_in=len(violations_monthly_indicators))
+
+    if append:
+        # Rows to add or replace: every month of new systems, new months of
+        # existing systems, and the changed cells (zero if no violation is left)
+        changed_cells = changed_cells.merge(
+            violations_monthly_indicators, on=["pws_key", "month"], how="left"
+        )
+        changed_cells[indicator_cols] = changed_cells[indicator_cols].fillna(0).astype(np.int8)
+
+        panel_data = pd.concat([
+            densify_panel(
+                violations_monthly_indicators, "pws_key", "month", indicator_cols,
+                entities=new_pws_keys, periods=date_range
+            ),
+            densify_panel(
+                violations_monthly_indicators, "pws_key", "month", indicator_cols,
+                entities=previous_pws_keys, periods=new_months
+            ),
+            changed_cells,
+        ], ignore_index=True)
+
+    else:
+        # Expand the sparse violation months to the full PWS x month panel, sorted
+        # by system key and month, with zeros for months without a violation
+        panel_data = densify_panel(
+            violations_monthly_indicators,
+            entity_col="pws_key",
+            period_col="month",
+            value_cols=indicator_cols,
+            entities=unique_pws_keys,
+            periods=date_range
+        )
+
+    # int32 system keys, plus the readable PWS ID as a categorical whose codes
+    # are the keys
+    panel_data["pws_key"] = panel_data["pws_key"].astype(np.int32)
+    panel_data.insert(0, "PWS ID", pws_keys().categorical(panel_data["pws_key"]))
+
+    # Extract year and month
+    panel_data["year"] = panel_data["month"].dt.year
+    panel_data["month_num"] = panel_data["month"].dt.month
+    report.stop(rows_out=len(panel_data))
+
+    print(f"Panel data shape: {panel_data.shape}")
+
+    # Per-system coverage: months with any violation, first/last violation month
+    # and gaps between violation spells (full builds only)
+    if not append:
+        pws_coverage = long_panel_diagnostics(
+            panel_data,
+            "pws_key",
+            "month",
+            observed=panel_data[indicator_cols].any(axis=1)
+        )
+
+        print("\nSummary of violation months per system:")
+        print(pws_coverage["n_observed"].describe())
+
+        print("\nSummary of separate violation spells per system:")
+        print((pws_coverage["n_gaps"] + (pws_coverage["n_observed"] > 0)).describe())
+
+    # -------------------------------------------------------------------------
+    # Save Final Data
+    # -------------------------------------------------------------------------
+    report.start("write", rows_in=len(panel_data))
+    if append:
+        # Save the new and replaced rows as a new partition of the panel
+        if len(panel_data):
+            append_partition(
+                panel_data,
+                panel_name,
+                partition=datetime.now().strftime("%Y%m%d-%H%M%S"),
+                key=["pws_key", "month"]
+            )
+        output_file = table_paths(panel_name)[0]
+    else:
+        output_file = write_table(panel_data, panel_name)
+
+    # Violations the panel was built from and its indicator columns, for
+    # comparison with the next download
+    write_table(
+        violations[["PWS ID", "pws_key", "compliance_begin", "end_date", "record_digest"]],
+        records_name
+    )
+    with open(indicators_path, "w") as f:
+        json.dump(indicator_cols, f)
+    report.stop()
+    print(f"\nFinal panel dataset saved to:\n{output_file}")
+    report.write()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+===============================================================================
+ Title: 02-create-ZCTA-exposure-panel.py
+ Description:
+     Links water system violations to home prices. Spreads the monthly
+     violation indicators of each CWS to the ZCTAs it serves, weighted by
+     the share of each ZCTA's area the system covers (from the PWS-to-ZTCA
+     crosswalk), and joins the resulting ZCTA x month exposure measures onto
+     the zip-code level home price panel. Works one year at a time so the
+     full panel never has to be held in memory.
+===============================================================================
+"""
+
+# -----------------------------------------------------------------------------
+# Import Libraries and Config
+# -----------------------------------------------------------------------------
+import argparse
+import pandas as pd
+import numpy as np
+
+# If running interactively, set the working directory to the code directory
+import config
+from storage import read_table, TableWriter
+from zillow_reshape import home_price_panel_name
+from exposure import CrosswalkWeights, exposure_for_year, exposure_panel_name
+from violation_indicators import indicator_names
+from instrumentation import RunReport, Progress
+
+
+def parse_args(argv=None):
+    """Command-line options of the script (`argv` defaults to sys.argv)."""
+    # Crosswalk vintage, minimum ZCTA coverage and violation types to link
+    # (config defaults - every indicator of the violations panel - or
+    # --vintage / --min-coverage / --indicators)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vintage", default=config.EXPOSURE_ZCTA_VINTAGE, choices=["2000", "2010"])
+    parser.add_argument("--min-coverage", type=float, default=config.EXPOSURE_MIN_COVERAGE)
+    parser.add_argument(
+        "--indicators", nargs="+",
+        default=indicator_names(config.VIOLATION_INDICATOR_RULES)
+    )
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def main(argv=None):
+    """
+    Build the ZCTA x month exposure panel. `argv` holds command-line options as
+    for the script (defaults to sys.argv).
+    """
+    args = parse_args(argv)
+
+    # Timing, memory and row counts for each step, saved as a JSON run report
+    report = RunReport("exposure")
+
+    home_price_name = home_price_panel_name(config.ZILLOW_STATES)
+
+    # -------------------------------------------------------------------------
+    # Load Crosswalk Weights
+    # -------------------------------------------------------------------------
+    print(f"Loading PWS to ZTCA {args.vintage} crosswalk...")
+
+    # Integer-coded system -> ZCTA edges, keeping systems that cover at least the
+    # minimum share of a ZCTA's area
+    report.start("weights")
+    crosswalk = read_table(
+        f"CA-PWS-to-ZTCA-{args.vintage}-crosswalk",
+        columns=["pws_key", "zcta_key", "coverage_frac_ztca"]
+    )
+    weights = CrosswalkWeights(crosswalk, min_coverage=args.min_coverage)
+    report.stop(rows_out=len(weights.edge_zcta))
+
+    print(f"Crosswalk edges with coverage >= {args.min_coverage:.0%}: {len(weights.edge_zcta):,} "
+          f"({len(weights.pws_keys):,} systems, {len(weights.zcta_keys):,} ZCTAs)")
+
+    # -------------------------------------------------------------------------
+    # Build Exposure Panel Year by Year
+    # -------------------------------------------------------------------------
+    years = np.sort(read_table(home_price_name, columns=["year"])["year"].unique())
+    print(f"Linking violations to home prices for {len(years)} years...")
+
+    # Rows with at least one of the selected violations; all other system-months
+    # contribute nothing to exposure, so they are filtered out in the read
+    any_violation = [[(col, "==", 1)] for col in args.indicators]
+
+    output_name = exposure_panel_name(args.vintage, args.min_coverage, args.indicators)
+    progress = Progress(len(years), "Years linked")
+
+    report.start("link")
+    with TableWriter(output_name) as writer:
+        for year in years:
+            # Select the year by date range on the panels' key date columns,
+            # which is also applied to each appended partition as it is read
+            start = pd.Timestamp(year=year, month=1, day=1)
+            end = pd.Timestamp(year=year + 1, month=1, day=1)
+            violations = read_table(
+                "CA_monthly_violation_panel",
+                columns=["pws_key", "month_num", *args.indicators],
+                filters=[
+                    [("month", ">=", start), ("month", "<", end), *conjunction]
+                    for conjunction in any_violation
+                ],
+                parse_dates=["month"]
+            )
+            home_prices = read_table(
+                home_price_name,
+                filters=[("date", ">=", start), ("date", "<", end)],
+                parse_dates=["date"]
+            )
+
+            writer.write(exposure_for_year(weights, violations, home_prices, args.indicators))
+            progress.update()
+    report.stop(rows_out=writer.n_rows)
+
+    print(f"Exposure panel rows: {writer.n_rows:,}")
+
+    # -------------------------------------------------------------------------
+    # Summaries
+    # -------------------------------------------------------------------------
+    exposure = read_table(output_name, columns=[f"{col}_any" for col in args.indicators])
+    print("\nShare of zip-months exposed by violation type:")
+    for col in args.indicators:
+        print(f"{col}: {exposure[f'{col}_any'].mean():.2%}")
+
+    print(f"\nExposure panel saved to:\n{writer.paths[0]}")
+
+    report.write()
+
+
+if __name__ == "__main__":
+    main()
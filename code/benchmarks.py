@@ -0,0 +1,276 @@
+"""
+===============================================================================
+ Title: benchmarks.py
+ Description:
+     Benchmarks the core routine of each pipeline stage on synthetic data,
+     so performance can be tracked without the private raw files. Generates
+     a ZHVI-shaped wide home price table, an SDWIS-shaped violations table
+     and random PWS / ZCTA polygon layers in EPSG:3310 at several scales,
+     times each routine, appends the results to a JSON-lines history file
+     and flags any benchmark that got slower than the previous run.
+
+     Usage (from the code directory):
+         python benchmarks.py                      # scales 1, 10 and 100
+         python benchmarks.py --scales 1 10 --repeat 5
+===============================================================================
+"""
+
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+import config
+from panel_utils import expand_to_monthly, expand_flags_to_monthly, densify_panel
+from violation_indicators import indicator_names, violation_flags, unpack_flags
+from zillow_reshape import zhvi_date_columns, reshape_zhvi_chunk, stream_zhvi_panel
+from crosswalk import build_crosswalk
+
+
+# Sizes at scale 1; every size is multiplied by the scale factor
+BASE_N_ZIPS = 500
+BASE_N_VIOLATIONS = 2000
+BASE_N_SYSTEMS = 200
+BASE_N_PWS_POLYGONS = 100
+
+N_MONTHS = 300
+INDICATOR_COLS = indicator_names(config.VIOLATION_INDICATOR_RULES)
+
+
+# -----------------------------------------------------------------------------
+# Synthetic Inputs
+# -----------------------------------------------------------------------------
+def make_zhvi_csv(path, n_zips, n_months=N_MONTHS, seed=0):
+    """Write a ZHVI-shaped wide CSV: ID columns plus one column per month."""
+    rng = np.random.default_rng(seed)
+    months = pd.date_range("2000-01-31", periods=n_months, freq="ME").strftime("%Y-%m-%d")
+    wide = pd.DataFrame({
+        "RegionID": np.arange(n_zips),
+        "SizeRank": np.arange(n_zips),
+        "RegionName": rng.integers(90001, 96162, n_zips),
+        "RegionType": "zip",
+        "StateName": "CA",
+        "State": rng.choice(["CA", "NV", "OR", "AZ"], n_zips, p=[0.4, 0.2, 0.2, 0.2]),
+        "City": [f"City {i % 900}" for i in range(n_zips)],
+        "Metro": [f"Metro {i % 40}" for i in range(n_zips)],
+        "CountyName": [f"County {i % 58}" for i in range(n_zips)],
+    })
+
+    # Random-walk prices; each zip enters the data at a random month
+    prices = 200_000 * np.exp(np.cumsum(rng.normal(0.003, 0.01, (n_zips, n_months)), axis=1))
+    first_month = rng.integers(0, n_months // 2, n_zips)
+    prices[np.arange(n_months) < first_month[:, None]] = np.nan
+    wide = pd.concat([wide, pd.DataFrame(prices.round(), columns=months)], axis=1)
+
+    wide.to_csv(path, index=False)
+    return path
+
+
+def make_violations(n_violations, n_systems, seed=0):
+    """
+    SDWIS-shaped violations after cleaning. Interval lengths follow a
+    lognormal distribution (median ~3 months, long right tail), as most
+    violations cover one monitoring period but some stay open for years.
+    """
+    rng = np.random.default_rng(seed)
+    begin = pd.Timestamp("1995-01-01") + pd.to_timedelta(rng.integers(0, 10_000, n_violations), unit="D")
+    length_days = np.minimum(rng.lognormal(np.log(90), 1.2, n_violations), 3650).astype(int)
+    return pd.DataFrame({
+        "PWS ID": [f"CA{i:07d}" for i in rng.integers(0, n_systems, n_violations)],
+        "Contaminant Name": rng.choice(
+            ["Arsenic", "Nitrate", "Nitrate-Nitrite", "1,2-DIBROMO-3-CHLOROPROPANE",
+             "Coliform (TCR)", "Gross Alpha"],
+            n_violations,
+        ),
+        "Public Notification Tier": rng.choice([1, 2], n_violations, p=[0.3, 0.7]),
+        "compliance_begin": begin,
+        "end_date": begin + pd.to_timedelta(length_days, unit="D"),
+    })
+
+
+def make_polygon_layers(n_pws, seed=0):
+    """
+    Random PWS service areas (buffered points of varying size) over a grid
+    of ZCTA-like cells, both in EPSG:3310. The ZCTA grid grows with the
+    number of systems so density stays comparable across scales.
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(4 * n_pws)))
+    cell = 10_000
+    x, y = np.meshgrid(np.arange(side) * cell, np.arange(side) * cell)
+    zcta = gpd.GeoDataFrame(
+        {"ZCTA5CE00": [f"9{i:05d}" for i in range(side * side)]},
+        geometry=shapely.box(x.ravel(), y.ravel(), x.ravel() + cell, y.ravel() + cell),
+        crs=3310,
+    )
+
+    centers = shapely.points(rng.uniform(0, side * cell, (n_pws, 2)))
+    radii = rng.lognormal(np.log(2_000), 0.8, n_pws)
+    pws = gpd.GeoDataFrame(
+        {"SABL_PWSID": [f"CA{i:07d}" for i in range(n_pws)]},
+        geometry=shapely.buffer(centers, radii, quad_segs=32),
+        crs=3310,
+    )
+    return pws, zcta
+
+
+# -----------------------------------------------------------------------------
+# Benchmarked Routines
+# -----------------------------------------------------------------------------
+def bench_melt(zhvi_csv):
+    wide = pd.read_csv(zhvi_csv)
+    wide = wide[wide["State"] == "CA"]
+    date_cols = zhvi_date_columns(wide.columns)
+    dates = pd.to_datetime(pd.Index(date_cols), format="%Y-%m-%d")
+    return lambda: reshape_zhvi_chunk(wide, date_cols, dates)
+
+
+def bench_stream(zhvi_csv):
+    def run():
+        for _ in stream_zhvi_panel(zhvi_csv, states=["CA"], chunksize=2000):
+            pass
+    return run
+
+
+def bench_expand(violations):
+    return lambda: expand_to_monthly(
+        violations, "compliance_begin", "end_date",
+        columns=["PWS ID", "Contaminant Name", "Public Notification Tier"],
+    )
+
+
+def bench_panel(violations):
+    def run():
+        flagged = violations.assign(
+            indicator_flags=violation_flags(violations, config.VIOLATION_INDICATOR_RULES)
+        )
+        monthly = expand_flags_to_monthly(
+            flagged[flagged["indicator_flags"] != 0], "PWS ID", "compliance_begin", "end_date",
+            "indicator_flags",
+        )
+        sparse = pd.concat([
+            monthly[["PWS ID", "month"]], unpack_flags(monthly["indicator_flags"], INDICATOR_COLS)
+        ], axis=1)
+        periods = pd.date_range(sparse["month"].min(), sparse["month"].max(), freq="MS")
+        return densify_panel(
+            sparse, "PWS ID", "month", INDICATOR_COLS,
+            np.sort(violations["PWS ID"].unique()), periods,
+        )
+    return run
+
+
+def bench_overlay(pws, zcta):
+    return lambda: build_crosswalk(pws, zcta)
+
+
+# -----------------------------------------------------------------------------
+# Runner
+# -----------------------------------------------------------------------------
+def time_call(func, repeat):
+    """Best and median wall time of `repeat` calls to func, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.median(times))
+
+
+def run_benchmarks(scales, repeat=3, seed=0):
+    """Time every benchmark at each scale. Returns a list of result records."""
+    results = []
+    for scale in scales:
+        tmp_dir = tempfile.TemporaryDirectory()
+        zhvi_csv = make_zhvi_csv(
+            os.path.join(tmp_dir.name, "zhvi.csv"), BASE_N_ZIPS * scale, seed=seed
+        )
+        violations = make_violations(BASE_N_VIOLATIONS * scale, BASE_N_SYSTEMS * scale, seed=seed)
+        pws, zcta = make_polygon_layers(BASE_N_PWS_POLYGONS * scale, seed=seed)
+
+        benchmarks = {
+            "zhvi_melt": (bench_melt(zhvi_csv), BASE_N_ZIPS * scale),
+            "zhvi_stream": (bench_stream(zhvi_csv), BASE_N_ZIPS * scale),
+            "violations_expand": (bench_expand(violations), len(violations)),
+            "violations_panel": (bench_panel(violations), len(violations)),
+            "crosswalk_overlay": (bench_overlay(pws, zcta), len(pws)),
+        }
+        for name, (func, n_input) in benchmarks.items():
+            best, median = time_call(func, repeat)
+            print(f"{name:<20} x{scale:<4} n={n_input:>9,}  best {best:8.3f}s  median {median:8.3f}s")
+            results.append({
+                "benchmark": name, "scale": scale, "n_input": n_input,
+                "best_s": round(best, 5), "median_s": round(median, 5),
+            })
+        tmp_dir.cleanup()
+    return results
+
+
+def compare_to_previous(results, history, tolerance, min_delta_s=0.01):
+    """
+    Print benchmarks whose best time grew by more than `tolerance` (a share)
+    and by at least `min_delta_s` seconds, so timer noise on very fast
+    benchmarks is not reported.
+    """
+    # Most recent earlier result for each benchmark and scale
+    previous = {(r["benchmark"], r["scale"]): r for r in history}
+    slower = []
+    for r in results:
+        before = previous.get((r["benchmark"], r["scale"]))
+        if before is None:
+            continue
+        if (r["best_s"] > before["best_s"] * (1 + tolerance)
+                and r["best_s"] - before["best_s"] >= min_delta_s):
+            slower.append((r, before))
+
+    if not slower:
+        print("\nNo slowdowns compared to the previous run.")
+    for r, before in slower:
+        print(f"\nSLOWER: {r['benchmark']} x{r['scale']}: "
+              f"{before['best_s']:.3f}s -> {r['best_s']:.3f}s "
+              f"(+{r['best_s'] / before['best_s'] - 1:.0%})")
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages on synthetic data.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="flag benchmarks slower than the last run by this share")
+    parser.add_argument("--output-dir", default=os.path.join(config.OUTPUT_OTHR_DIR, "benchmarks"))
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    history_file = os.path.join(args.output_dir, "benchmark-history.jsonl")
+
+    history = []
+    if os.path.exists(history_file):
+        with open(history_file) as f:
+            history = [json.loads(line) for line in f if line.strip()]
+
+    results = run_benchmarks(args.scales, args.repeat)
+    slower = compare_to_previous(results, history, args.tolerance)
+
+    run_info = {
+        "run_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "shapely": shapely.__version__,
+        "machine": platform.node(),
+    }
+    with open(history_file, "a") as f:
+        for r in results:
+            f.write(json.dumps({**run_info, **r}) + "\n")
+    print(f"\nResults appended to {history_file}")
+
+    # Non-zero exit status when something got slower, for scripted checks
+    raise SystemExit(1 if slower else 0)
@@ -9,15 +9,24 @@
 
 import os
 
-# Absolute path to your GitHub repo (code + output)
-PROJECT_DIR = r"C:\Users\macka\github-repos\water-quality-home-prices"
+# Absolute path to your GitHub repo (code + output). Defaults to the repo this
+# file is in; can be overridden with the WQHP_PROJECT_DIR environment variable
+# (or pipeline.py --project-dir)
+PROJECT_DIR = os.environ.get(
+    "WQHP_PROJECT_DIR",
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
 
-# Absolute path to your Google Drive data folder
-DATA_DIR = r"G:\My Drive\research\water-stuff\python-data-files"
+# Absolute path to your Google Drive data folder. Can be overridden with the
+# WQHP_DATA_DIR environment variable (or pipeline.py --data-dir)
+DATA_DIR = os.environ.get(
+    "WQHP_DATA_DIR",
+    r"G:\My Drive\research\water-stuff\python-data-files"
+)
 
 # Relative subdirectories for code & output 
 
-CODE_DIR = os.path.join(PROJECT_DIR, "code")
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
 NOTEBOOK_DIR = os.path.join(PROJECT_DIR, "output")
 OUTPUT_DIR = os.path.join(PROJECT_DIR, "output")
 OUTPUT_TBL_DIR = os.path.join(OUTPUT_DIR, "tables")
@@ -34,3 +43,88 @@ RAW_EPA_DIR = os.path.join(RAW_DATA_DIR, "EPA-SDWIS-downloads")
 RAW_ZCTA_DIR = os.path.join(RAW_DATA_DIR, "ZCTA-census-boundaries")
 
 PROCESSED_DATA_DIR = os.path.join(DATA_DIR, "processed-data")
+
+# Cache of stage outputs used by pipeline.py to skip unchanged stages
+CACHE_DIR = os.path.join(DATA_DIR, "cache")
+
+# -----------------------------------------------------------------------------
+# Pipeline settings
+# -----------------------------------------------------------------------------
+
+# Build the PWS-to-ZCTA crosswalk for every CA water system, not only those
+# with violations
+CROSSWALK_ALL_PWS = False
+
+# Worker processes for the PWS-to-ZCTA overlay (1 = serial). Can be overridden
+# with --workers when running the mapping script
+CROSSWALK_N_WORKERS = 1
+
+# Update the PWS-to-ZCTA crosswalks from the previous run's outputs, only
+# recomputing systems whose boundaries changed. Can also be turned on with
+# --incremental when running the mapping script
+CROSSWALK_INCREMENTAL = False
+
+# Fast mode for exploratory crosswalks: simplify PWS and ZCTA polygons with
+# this tolerance and/or snap them to a grid of this size before intersecting
+# (meters in EPSG:3310, 0 = exact geometries). Can be overridden with
+# --simplify / --grid-size, and --check-fast also runs the exact overlay and
+# reports the error in coverage_frac_ztca
+CROSSWALK_SIMPLIFY_TOLERANCE = 0.0
+CROSSWALK_GRID_SIZE = 0.0
+
+# Monthly violation indicators of the violations panel. Each rule sets an
+# indicator for violations of a contaminant and/or public notification tier
+# (a missing key matches any value); "exclude" rules remove matches from it.
+# Indicators are panel columns in order of first appearance (at most 64)
+VIOLATION_INDICATOR_RULES = [
+    {"indicator": "arsenic", "contaminant": "Arsenic"},
+    {"indicator": "nitrate", "contaminant": "Nitrate"},
+    {"indicator": "nitrate", "contaminant": "Nitrate-Nitrite"},
+    {"indicator": "dbcp", "contaminant": "1,2-DIBROMO-3-CHLOROPROPANE"},
+    {"indicator": "tier1_all", "tier": 1},
+    {"indicator": "tier1_other", "tier": 1},
+    {"indicator": "tier1_other", "contaminant": "Nitrate", "exclude": True},
+    {"indicator": "tier1_other", "contaminant": "Nitrate-Nitrite", "exclude": True},
+]
+
+# Violation indicators that select the water systems mapped to ZCTAs (systems
+# with any of them in some month), from the indicators defined above
+CROSSWALK_INDICATORS = ["tier1_all", "arsenic", "dbcp"]
+
+# ZCTA vintage of the crosswalk used to link violations to home prices, and
+# the minimum share of a ZCTA's area a water system must cover to count
+# towards its exposure. Can be overridden with --vintage / --min-coverage when
+# running the exposure script
+EXPOSURE_ZCTA_VINTAGE = "2010"
+EXPOSURE_MIN_COVERAGE = 0.0
+
+# Maximum size of the stage cache before least recently used entries are
+# evicted (bytes)
+CACHE_MAX_BYTES = 20 * 1024**3
+
+# Format of processed datasets: "parquet" (GeoParquet for geometries) or "csv"
+# (GEO_EXPORT_FORMAT for geometries)
+PROCESSED_FORMAT = "parquet"
+
+# Also write a CSV / geometry export copy of each processed dataset
+EXPORT_CSV = False
+
+# Format of geometry exports (and of geometries when PROCESSED_FORMAT is
+# "csv"): "fgb" (FlatGeobuf with a spatial index, for fast bbox reads) or
+# "geojson"
+GEO_EXPORT_FORMAT = "fgb"
+
+# States kept from the national Zillow ZHVI file (None = all states)
+ZILLOW_STATES = ["CA"]
+
+# Stream the ZHVI file in chunks of this many zips instead of loading it whole
+ZILLOW_STREAMING = False
+ZILLOW_CHUNKSIZE = 2000
+
+# Append only the new months / records of a data release to the existing home
+# price and violations panels, as a new partition, instead of rebuilding
+# them. Can also be turned on with --append when running those scripts
+PANEL_APPEND = False
+
+# Track Python heap peaks with tracemalloc in stage run reports (slows runs)
+PROFILE_TRACEMALLOC = False
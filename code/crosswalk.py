@@ -0,0 +1,496 @@
+"""
+===============================================================================
+ Title: crosswalk.py
+ Description:
+     Builds area-weighted crosswalks between water system (PWS) service
+     boundaries and Zip Code Tabulation Areas (ZCTAs). All candidate
+     PWS x ZCTA pairs are found with one bulk spatial index query and their
+     overlaps are computed with vectorized Shapely 2 operations, instead of
+     running a separate overlay for each water system. Several target
+     layers (e.g. ZCTA vintages) can be crosswalked in one pass that shares
+     the PWS geometry preparation, a sharded, multi-process variant is
+     available for large layers, and existing crosswalks can be updated
+     incrementally when only some PWS boundaries change. Target layers can
+     be GeoDataFrames or memory-mapped SpatialLayers from the layer cache
+     (spatial_cache.py), which worker processes open by path instead of
+     receiving the geometries. For exploratory runs, layers can be
+     simplified and snapped to a coarser grid before intersecting, with the
+     resulting error measured against an exact run.
+===============================================================================
+"""
+
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from instrumentation import Progress
+from spatial_cache import SpatialLayer, open_layer
+
+
+def fast_mode_suffix(tolerance=0.0, grid_size=0.0):
+    """
+    Suffix of the dataset names of fast-mode crosswalks (simplified and/or
+    grid-snapped, in meters), so they never replace the exact crosswalks.
+    Empty for exact runs.
+    """
+    if tolerance > 0 or grid_size > 0:
+        return f"-fast-simplify{tolerance:g}-grid{grid_size:g}"
+    return ""
+
+
+# -----------------------------------------------------------------------------
+# Geometry Helpers
+# -----------------------------------------------------------------------------
+def _geometries(layer):
+    """Geometry array of a GeoDataFrame or SpatialLayer."""
+    if isinstance(layer, SpatialLayer):
+        return layer.geoms
+    return np.asarray(layer.geometry.array)
+
+
+def _spatial_index(layer):
+    """STRtree of a GeoDataFrame or SpatialLayer, built once per layer."""
+    if isinstance(layer, SpatialLayer):
+        return layer.tree
+    return layer.sindex
+
+
+def _keep_polygonal(geoms):
+    """
+    Keep only the polygonal part of each intersection, mirroring
+    gpd.overlay(..., keep_geom_type=True). Lines and points from polygons
+    that only touch are dropped (returned as empty geometries).
+    """
+    geoms = np.array(geoms, dtype=object)
+    type_ids = shapely.get_type_id(geoms)
+
+    # Pull polygons out of any mixed geometry collections
+    for i in np.flatnonzero(type_ids == shapely.GeometryType.GEOMETRYCOLLECTION):
+        parts = shapely.get_parts(geoms[i])
+        polygons = parts[np.isin(
+            shapely.get_type_id(parts),
+            [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON]
+        )]
+        geoms[i] = shapely.union_all(polygons)
+
+    type_ids = shapely.get_type_id(geoms)
+    non_polygonal = ~np.isin(
+        type_ids, [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON]
+    )
+    geoms[non_polygonal] = shapely.Polygon()
+    return geoms
+
+
+def _intersect_pairs(pws_geoms, zcta_geoms, zcta_tree):
+    """
+    Find and intersect all overlapping PWS x ZCTA pairs.
+
+    Returns positional PWS and ZCTA indices, sorted by (PWS, ZCTA), plus the
+    polygonal intersection for each pair. Pairs that only touch are dropped.
+    """
+    pws_idx, zcta_idx = zcta_tree.query(pws_geoms, predicate="intersects")
+    order = np.lexsort((zcta_idx, pws_idx))
+    pws_idx, zcta_idx = pws_idx[order], zcta_idx[order]
+
+    pieces = _keep_polygonal(shapely.intersection(pws_geoms[pws_idx], zcta_geoms[zcta_idx]))
+    keep = ~shapely.is_empty(pieces)
+    return pws_idx[keep], zcta_idx[keep], pieces[keep]
+
+
+def _assemble_crosswalk(pws, zcta, pws_idx, zcta_idx, pieces, pws_id_col, zcta_id_col):
+    """Turn intersected pairs into the crosswalk table and overlap layer."""
+    pws_ids = pws[pws_id_col].to_numpy()
+    zcta_ids = zcta[zcta_id_col].to_numpy()
+    zcta_area = shapely.area(_geometries(zcta))
+    intersect_area = shapely.area(pieces)
+
+    # Systems with no overlapping ZCTA get a single zero-coverage row
+    unmatched_idx = np.setdiff1d(np.arange(len(pws)), pws_idx)
+    n_unmatched = len(unmatched_idx)
+
+    # Splice matched and unmatched rows back together in PWS order
+    row_pws = np.concatenate([pws_idx, unmatched_idx])
+    order = np.argsort(row_pws, kind="stable")
+    row_area = np.concatenate([intersect_area, np.zeros(n_unmatched)])
+    row_zcta = np.concatenate([zcta_ids[zcta_idx].astype(object), np.full(n_unmatched, None)])
+    row_zcta_area = np.concatenate([zcta_area[zcta_idx], np.full(n_unmatched, np.nan)])
+    row_coverage = np.concatenate([intersect_area / zcta_area[zcta_idx], np.zeros(n_unmatched)])
+
+    crosswalk = pd.DataFrame({
+        pws_id_col: pws_ids[row_pws[order]],
+        "intersect_area_m2": row_area[order],
+        zcta_id_col: row_zcta[order],
+        "zcta_area_m2": row_zcta_area[order],
+        "coverage_frac_ztca": row_coverage[order],
+    })
+
+    overlaps = gpd.GeoDataFrame({
+        pws_id_col: pws_ids[pws_idx],
+        zcta_id_col: zcta_ids[zcta_idx],
+        "geometry": pieces,
+    }, geometry="geometry", crs=pws.crs)
+
+    return crosswalk, overlaps
+
+
+# -----------------------------------------------------------------------------
+# Crosswalk Engine
+# -----------------------------------------------------------------------------
+def prepare_pws_geometries(pws):
+    """
+    Geometry array of a dissolved, reprojected PWS layer, prepared once with
+    shapely.prepare so every ZCTA layer queried against it reuses the same
+    prepared geometries instead of preparing them again per layer.
+    """
+    pws_geoms = np.asarray(pws.geometry.array)
+    shapely.prepare(pws_geoms)
+    return pws_geoms
+
+
+def build_crosswalks(pws, layers, n_workers=1, pws_id_col="SABL_PWSID", shards_per_worker=4):
+    """
+    Intersect every PWS polygon with every polygon it overlaps in each of
+    several target layers (e.g. the 2000 and 2010 ZCTA vintages) in one pass.
+
+    `layers` maps a layer name to a (layer, ID column) tuple, where a layer
+    is a GeoDataFrame or SpatialLayer. All layers must share the CRS of
+    `pws`, a projected, equal-area CRS (EPSG:3310 for this project), and
+    `pws` should have one row per system (i.e. dissolved). PWS geometries
+    are prepared once and each layer's spatial index is built once. With more than one worker the PWS polygons are
+    sharded across processes, each of which holds every layer (see
+    build_crosswalk_parallel).
+
+    Returns a dict mapping each layer name to a (crosswalk, overlaps) tuple:
+        - crosswalk: DataFrame with the PWS ID, intersection area, target ID,
+          target area and the share of the target covered by the system.
+          Systems with no overlapping target get a single row with zero
+          coverage.
+        - overlaps: GeoDataFrame of the intersection polygons with PWS and
+          target IDs, for plotting and visual checks.
+    Rows are ordered by the position of the system in `pws`, then by the
+    position of the target polygon in its layer.
+    """
+    if n_workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        pairs = _intersect_layers_parallel(pws, layers, n_workers, shards_per_worker)
+    else:
+        pws_geoms = prepare_pws_geometries(pws)
+        pairs = {
+            name: _intersect_pairs(pws_geoms, _geometries(zcta), _spatial_index(zcta))
+            for name, (zcta, _) in layers.items()
+        }
+
+    return {
+        name: _assemble_crosswalk(pws, zcta, *pairs[name], pws_id_col, zcta_id_col)
+        for name, (zcta, zcta_id_col) in layers.items()
+    }
+
+
+def build_crosswalk(pws, zcta, pws_id_col="SABL_PWSID", zcta_id_col="ZCTA5CE00"):
+    """
+    Crosswalk between `pws` and a single ZCTA layer, computed in this
+    process. See build_crosswalks for the inputs and the returned
+    (crosswalk, overlaps) tuple.
+    """
+    layers = {"zcta": (zcta, zcta_id_col)}
+    return build_crosswalks(pws, layers, n_workers=1, pws_id_col=pws_id_col)["zcta"]
+
+
+# -----------------------------------------------------------------------------
+# Parallel Sharded Crosswalk
+# -----------------------------------------------------------------------------
+def _to_wkb(geoms):
+    """
+    WKB and grid size of each geometry, to send to worker processes. WKB
+    drops the grid set by simplify_layer, which intersections are computed
+    on.
+    """
+    return shapely.to_wkb(geoms), shapely.get_precision(geoms)
+
+
+def _from_wkb(wkb, grid_size):
+    """Geometries sent with _to_wkb, snapped to their grid again."""
+    geoms = shapely.from_wkb(wkb)
+    snapped = grid_size > 0
+    geoms[snapped] = shapely.set_precision(geoms[snapped], grid_size[snapped])
+    return geoms
+
+
+# Target layers loaded once per worker process by _init_worker, as
+# {layer name: GeoDataFrame or SpatialLayer}; spatial indexes are built on
+# the first shard
+_worker_layers = None
+
+
+def _init_worker(layer_sources):
+    """Open cached layers by path and decode the others from WKB."""
+    global _worker_layers
+    _worker_layers = {}
+    for name, source in layer_sources.items():
+        if isinstance(source, str):
+            _worker_layers[name] = open_layer(source)
+        else:
+            _worker_layers[name] = gpd.GeoDataFrame(geometry=_from_wkb(*source))
+
+
+def _intersect_shard(pws_positions, pws_wkb):
+    """Intersect one shard of PWS polygons against each of the worker's layers."""
+    pws_geoms = _from_wkb(*pws_wkb)
+    shapely.prepare(pws_geoms)
+    results = {}
+    for name, layer in _worker_layers.items():
+        shard_idx, zcta_idx, pieces = _intersect_pairs(
+            pws_geoms, _geometries(layer), _spatial_index(layer)
+        )
+        results[name] = (pws_positions[shard_idx], zcta_idx, shapely.to_wkb(pieces))
+    return results
+
+
+def shard_by_hilbert(geoms, n_shards):
+    """
+    Split geometries into `n_shards` spatially coherent groups of positions,
+    ordering them along a Hilbert curve through their bounding-box centers.
+    Missing and empty geometries (e.g. polygons collapsed by grid snapping)
+    can't overlap anything and have no position on the curve, so they are
+    left out; like in a serial run, their systems end up unmatched.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    valid = np.flatnonzero(~(shapely.is_missing(geoms) | shapely.is_empty(geoms)))
+    if len(valid) == 0:
+        return []
+    distance = gpd.GeoSeries(geoms[valid]).hilbert_distance().to_numpy()
+    order = valid[np.argsort(distance, kind="stable")]
+    return [shard for shard in np.array_split(order, n_shards) if len(shard)]
+
+
+def _intersect_layers_parallel(pws, layers, n_workers, shards_per_worker):
+    """
+    Intersected (PWS, target) pairs for every layer, computed in a pool of
+    forked processes. PWS polygons are split into Hilbert-ordered shards and
+    each shard is serialized once and intersected against all layers.
+    Cached layers are sent as their cache directory, other layers as WKB.
+    """
+    pws_geoms = np.asarray(pws.geometry.array)
+    shards = shard_by_hilbert(pws_geoms, n_workers * shards_per_worker)
+    layer_sources = {
+        name: (
+            zcta.cache_dir if isinstance(zcta, SpatialLayer)
+            else _to_wkb(_geometries(zcta))
+        )
+        for name, (zcta, _) in layers.items()
+    }
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_worker,
+        initargs=(layer_sources,),
+    ) as executor:
+        progress = Progress(len(pws_geoms), "PWS polygons intersected")
+        results = []
+        for shard, result in zip(shards, executor.map(
+            _intersect_shard,
+            shards,
+            [_to_wkb(pws_geoms[shard]) for shard in shards],
+        )):
+            results.append(result)
+            progress.update(len(shard))
+
+    # Merge shards deterministically in (PWS, target) order
+    pairs = {}
+    for name in layers:
+        parts = [r[name] for r in results]
+        pws_idx = np.concatenate([p[0] for p in parts] + [np.empty(0, dtype=np.intp)])
+        zcta_idx = np.concatenate([p[1] for p in parts] + [np.empty(0, dtype=np.intp)])
+        pieces = shapely.from_wkb(np.concatenate([p[2] for p in parts] + [np.empty(0, dtype=object)]))
+        order = np.lexsort((zcta_idx, pws_idx))
+        pairs[name] = (pws_idx[order], zcta_idx[order], pieces[order])
+    return pairs
+
+
+def build_crosswalk_parallel(pws, zcta, n_workers, pws_id_col="SABL_PWSID",
+                             zcta_id_col="ZCTA5CE00", shards_per_worker=4):
+    """
+    Same output as build_crosswalk, computed across a pool of processes.
+
+    PWS polygons are split into Hilbert-ordered shards and each shard is
+    intersected in a ProcessPoolExecutor worker that loads the ZCTA layer at
+    startup (opening a cached SpatialLayer by path, or decoding a
+    GeoDataFrame sent once as WKB) and builds its spatial index on the first
+    shard. Partial results are merged by (PWS, ZCTA) position so the
+    crosswalk matches a serial run row for row. Falls back to a serial run
+    when only one worker is requested or the platform cannot fork worker
+    processes.
+    """
+    layers = {"zcta": (zcta, zcta_id_col)}
+    return build_crosswalks(pws, layers, n_workers, pws_id_col, shards_per_worker)["zcta"]
+
+
+# -----------------------------------------------------------------------------
+# Incremental Updates
+# -----------------------------------------------------------------------------
+def geometry_digests(geoms):
+    """SHA-256 hex digest of the WKB of each geometry (of b"" if missing)."""
+    return np.array([hashlib.sha256(wkb or b"").hexdigest() for wkb in shapely.to_wkb(geoms)])
+
+
+def layer_digest(layer, id_col):
+    """
+    Single SHA-256 digest of a target layer's IDs and geometries. The same
+    for a GeoDataFrame and the SpatialLayer cached from it.
+    """
+    if isinstance(layer, SpatialLayer):
+        wkbs = layer.wkb()
+    else:
+        wkbs = shapely.to_wkb(np.asarray(layer.geometry.array))
+    digest = hashlib.sha256()
+    for layer_id, wkb in zip(layer[id_col].astype(str), wkbs):
+        digest.update(layer_id.encode())
+        digest.update(wkb or b"")
+    return digest.hexdigest()
+
+
+def crosswalk_state(pws, layers, pws_id_col="SABL_PWSID"):
+    """
+    Digests describing the inputs of a crosswalk run: one per PWS geometry
+    and one per target layer. Saved next to the crosswalks so the next run
+    can tell which systems changed (see update_crosswalks).
+    """
+    return {
+        "pws": dict(zip(pws[pws_id_col].astype(str), geometry_digests(np.asarray(pws.geometry.array)))),
+        "layers": {name: layer_digest(zcta, zcta_id_col) for name, (zcta, zcta_id_col) in layers.items()},
+    }
+
+
+def _splice(previous, new, keep_ids, pws_ids, pws_id_col):
+    """Previous rows of unchanged systems plus new rows, in `pws_ids` order."""
+    old = previous[previous[pws_id_col].astype(str).isin(keep_ids)]
+    combined = pd.concat([old, new], ignore_index=True)
+    position = pd.Series(np.arange(len(pws_ids)), index=pws_ids)
+    order = np.argsort(position.loc[combined[pws_id_col].astype(str)].to_numpy(), kind="stable")
+    return combined.iloc[order].reset_index(drop=True)
+
+
+def update_crosswalks(pws, layers, previous, previous_state, n_workers=1, pws_id_col="SABL_PWSID"):
+    """
+    Update crosswalks from a previous run, recomputing only what changed.
+
+    `previous` maps layer names to the (crosswalk, overlaps) tuples of the
+    previous run and `previous_state` is its crosswalk_state. Systems that
+    are new, whose dissolved geometry changed (by WKB digest), or that were
+    not in the previous subset are intersected again. Systems no longer in
+    `pws` are dropped, and rows for unchanged systems are reused. A layer
+    whose digest changed, or that has no previous result, is recomputed in
+    full. Output rows are in the same order as build_crosswalks would give.
+
+    Returns (crosswalks, state, n_recomputed): crosswalks as returned by
+    build_crosswalks, the new crosswalk_state and the number of systems
+    that were intersected again.
+    """
+    state = crosswalk_state(pws, layers, pws_id_col)
+    pws_ids = pws[pws_id_col].astype(str).to_numpy()
+    old_digests = previous_state.get("pws", {})
+    unchanged = np.array([old_digests.get(i) == d for i, d in state["pws"].items()], dtype=bool)
+
+    # Layers that changed (or were never built) need every system intersected
+    stale_layers = {
+        name: layer for name, layer in layers.items()
+        if name not in previous
+        or previous_state.get("layers", {}).get(name) != state["layers"][name]
+    }
+    fresh_layers = {name: layer for name, layer in layers.items() if name not in stale_layers}
+
+    crosswalks = {}
+    if stale_layers:
+        crosswalks.update(build_crosswalks(pws, stale_layers, n_workers, pws_id_col))
+
+    changed = pws[~unchanged]
+    if fresh_layers:
+        new = build_crosswalks(changed, fresh_layers, n_workers, pws_id_col) if len(changed) else {}
+        keep_ids = pws_ids[unchanged]
+        for name in fresh_layers:
+            old_crosswalk, old_overlaps = previous[name]
+            new_crosswalk, new_overlaps = new.get(name, (old_crosswalk.iloc[:0], old_overlaps.iloc[:0]))
+            crosswalks[name] = (
+                _splice(old_crosswalk, new_crosswalk, keep_ids, pws_ids, pws_id_col),
+                _splice(old_overlaps, new_overlaps, keep_ids, pws_ids, pws_id_col),
+            )
+
+    n_recomputed = len(pws) if stale_layers else len(changed)
+    return {name: crosswalks[name] for name in layers}, state, n_recomputed
+
+
+# -----------------------------------------------------------------------------
+# Fast Mode (Simplified Geometries)
+# -----------------------------------------------------------------------------
+def simplify_layer(layer, tolerance=0.0, grid_size=0.0):
+    """
+    Copy of `layer` with fewer vertices, for fast exploratory crosswalks.
+
+    Geometries are simplified with topology-preserving Douglas-Peucker at
+    `tolerance` and then snapped to a grid of `grid_size` with
+    shapely.set_precision (both in CRS units, i.e. meters in EPSG:3310). A
+    value of 0 skips that step. Polygons smaller than the grid may collapse
+    to empty geometries, which then match no ZCTA. SpatialLayers are
+    returned as GeoDataFrames.
+    """
+    if isinstance(layer, SpatialLayer):
+        layer = layer.to_geodataframe()
+    geoms = np.asarray(layer.geometry.array)
+    if tolerance > 0:
+        geoms = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    if grid_size > 0:
+        geoms = shapely.set_precision(geoms, grid_size)
+
+    layer = layer.copy()
+    layer[layer.geometry.name] = gpd.GeoSeries(geoms, index=layer.index, crs=layer.crs)
+    return layer
+
+
+def count_vertices(layer):
+    """Total number of coordinates in a layer's geometries."""
+    return int(shapely.get_num_coordinates(_geometries(layer)).sum())
+
+
+def compare_crosswalks(exact, fast, zcta_id_col, pws_id_col="SABL_PWSID"):
+    """
+    Error in coverage_frac_ztca of a fast-mode crosswalk against the exact
+    one. PWS x ZCTA pairs found in only one of the two count with zero
+    coverage in the other.
+
+    Returns (pairs, summary): a DataFrame with the exact and fast coverage
+    and their difference for every pair, and a dict with pair counts and
+    the mean, 95th/99th percentile and maximum absolute error.
+    """
+    key = [pws_id_col, zcta_id_col]
+
+    def coverage(crosswalk):
+        matched = crosswalk[crosswalk[zcta_id_col].notna()]
+        return matched[key + ["coverage_frac_ztca"]].astype({col: str for col in key})
+
+    pairs = coverage(exact).merge(
+        coverage(fast), on=key, how="outer", suffixes=("_exact", "_fast"), indicator=True
+    )
+    pairs[["coverage_frac_ztca_exact", "coverage_frac_ztca_fast"]] = (
+        pairs[["coverage_frac_ztca_exact", "coverage_frac_ztca_fast"]].fillna(0.0)
+    )
+    pairs["error"] = pairs["coverage_frac_ztca_fast"] - pairs["coverage_frac_ztca_exact"]
+
+    abs_error = pairs["error"].abs().to_numpy()
+    if len(abs_error) == 0:
+        abs_error = np.zeros(1)
+    summary = {
+        "n_pairs_exact": int((pairs["_merge"] != "right_only").sum()),
+        "n_pairs_fast": int((pairs["_merge"] != "left_only").sum()),
+        "n_pairs_only_exact": int((pairs["_merge"] == "left_only").sum()),
+        "n_pairs_only_fast": int((pairs["_merge"] == "right_only").sum()),
+        "mean_abs_error": float(abs_error.mean()),
+        "p95_abs_error": float(np.quantile(abs_error, 0.95)),
+        "p99_abs_error": float(np.quantile(abs_error, 0.99)),
+        "max_abs_error": float(abs_error.max()),
+    }
+    return pairs.drop(columns="_merge"), summary
@@ -0,0 +1,57 @@
+"""
+===============================================================================
+ Title: digests.py
+ Description:
+     Content digests of files, shared by the pipeline runner (stage
+     fingerprints) and the caches keyed on raw input files (SDWIS report
+     conversion, reprojected shapefile layers). A hash index saved as JSON
+     lets later runs reuse the digests of files whose size and modification
+     time are unchanged. Kept free of project imports so any module can use
+     it.
+===============================================================================
+"""
+
+import os
+import json
+import hashlib
+
+
+def file_digest(path, hash_index=None):
+    """
+    SHA-256 of a file's contents. If `hash_index` is given, the digest is
+    reused as long as the file's size and modification time are unchanged,
+    so large raw files are only re-read after they are touched.
+    """
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    key = os.path.abspath(path)
+
+    if hash_index is not None and hash_index.get(key, {}).get("signature") == signature:
+        return hash_index[key]["digest"]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    digest = digest.hexdigest()
+
+    if hash_index is not None:
+        hash_index[key] = {"signature": signature, "digest": digest}
+    return digest
+
+
+def load_hash_index(path):
+    """Hash index saved at `path` for file_digest (empty if there is none)."""
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_hash_index(index, path):
+    """Save a hash index to `path`, replacing the file in one step."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, path)
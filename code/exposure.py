@@ -0,0 +1,146 @@
+"""
+===============================================================================
+ Title: exposure.py
+ Description:
+     Links the monthly violations panel to ZCTAs through the PWS-to-ZCTA
+     crosswalk, matching on the shared integer system and ZCTA keys (see
+     keys.py). Crosswalk rows are turned once into integer-coded edges
+     sorted by system, so each month's violation indicators are spread to
+     ZCTAs with sorted-array lookups and np.bincount instead of string
+     merges. Only the system-months with a violation are touched, which
+     keeps regeneration for other violation types or coverage thresholds
+     cheap.
+===============================================================================
+"""
+
+import hashlib
+import numpy as np
+
+import config
+from violation_indicators import indicator_names
+
+
+def exposure_panel_name(vintage, min_coverage=0.0, indicators=None):
+    """
+    Processed dataset name for an exposure panel. A coverage threshold is
+    added as given (e.g. "-cov0.25"), and a subset of the configured
+    violation indicators as a short hash of the indicator names.
+    """
+    name = f"CA-ZCTA-{vintage}-exposure-panel"
+    if min_coverage > 0:
+        name += f"-cov{min_coverage:g}"
+    if indicators is not None and set(indicators) != set(indicator_names(config.VIOLATION_INDICATOR_RULES)):
+        digest = hashlib.sha256(",".join(sorted(set(indicators))).encode()).hexdigest()
+        name += f"-ind{digest[:8]}"
+    return name
+
+
+def _positions(sorted_keys, keys):
+    """Position of each key in the sorted array `sorted_keys` (-1 if absent)."""
+    keys = np.asarray(keys, dtype=np.int64)
+    if len(sorted_keys) == 0:
+        return np.full(len(keys), -1)
+    pos = np.clip(np.searchsorted(sorted_keys, keys), 0, len(sorted_keys) - 1)
+    return np.where(sorted_keys[pos] == keys, pos, -1)
+
+
+class CrosswalkWeights:
+    """
+    Area weights from a PWS-to-ZCTA crosswalk, as integer-coded edges.
+
+    Each crosswalk row with a ZCTA and coverage_frac_ztca >= `min_coverage`
+    becomes an edge from a system (coded by its position in the sorted
+    array of system keys `pws_keys`) to a ZCTA (coded by its position in
+    the sorted array of ZCTA keys `zcta_keys`), with the share of the
+    ZCTA's area the system covers as its weight. Keys come from the shared
+    dictionaries in keys.py. Edges are sorted by system, so the edges of
+    system i are edge_zcta[edge_start[i]:edge_start[i + 1]].
+    """
+
+    def __init__(self, crosswalk, min_coverage=0.0, pws_key_col="pws_key", zcta_key_col="zcta_key"):
+        self.min_coverage = min_coverage
+        edges = crosswalk[
+            (crosswalk[zcta_key_col] >= 0) &
+            (crosswalk["coverage_frac_ztca"] >= min_coverage) &
+            (crosswalk["coverage_frac_ztca"] > 0)
+        ]
+
+        self.pws_keys, pws_codes = np.unique(
+            edges[pws_key_col].to_numpy(dtype=np.int64), return_inverse=True
+        )
+        self.zcta_keys, zcta_codes = np.unique(
+            edges[zcta_key_col].to_numpy(dtype=np.int64), return_inverse=True
+        )
+
+        order = np.argsort(pws_codes, kind="stable")
+        self.edge_zcta = zcta_codes[order]
+        self.edge_weight = edges["coverage_frac_ztca"].to_numpy(dtype=np.float64)[order]
+        self.edge_start = np.concatenate([
+            [0], np.cumsum(np.bincount(pws_codes, minlength=len(self.pws_keys)))
+        ])
+
+    def pws_codes(self, pws_keys):
+        """Position of each system key in self.pws_keys (-1 if not in the crosswalk)."""
+        return _positions(self.pws_keys, pws_keys)
+
+    def zcta_positions(self, zcta_keys):
+        """Position of each zip/ZCTA key in self.zcta_keys (-1 if absent)."""
+        return _positions(self.zcta_keys, zcta_keys)
+
+    def spread(self, pws_codes, periods, n_periods):
+        """
+        Spread system-periods with a violation (`pws_codes`, integer
+        `periods` in [0, n_periods)) to ZCTAs. Returns two (n_zctas x
+        n_periods) arrays: the summed area share of the ZCTA covered by
+        systems in violation, and whether any such system covers it.
+        """
+        keep = pws_codes >= 0
+        pws_codes, periods = pws_codes[keep], periods[keep]
+
+        # Expand each system-period to the system's edges with repeat/offsets
+        starts = self.edge_start[pws_codes]
+        n_edges = self.edge_start[pws_codes + 1] - starts
+        first_out = np.cumsum(n_edges) - n_edges
+        edge_idx = np.repeat(starts - first_out, n_edges) + np.arange(n_edges.sum())
+
+        cell = self.edge_zcta[edge_idx] * n_periods + np.repeat(periods, n_edges)
+        size = len(self.zcta_keys) * n_periods
+        share = np.bincount(cell, weights=self.edge_weight[edge_idx], minlength=size)
+        covered = np.bincount(cell, minlength=size) > 0
+        return share.reshape(-1, n_periods), covered.reshape(-1, n_periods)
+
+
+def exposure_for_year(weights, violations, home_prices, indicator_cols,
+                      pws_col="pws_key", zip_col="zcta_key"):
+    """
+    Area-weighted violation exposure for one year of the home price panel.
+
+    `violations` holds rows of the violations panel for the year (only rows
+    with a violation are needed) with the system key `pws_col`, `month_num`
+    and the `indicator_cols`; `home_prices` holds the home price panel rows
+    for the same year with the zip key `zip_col` and `month`. Returns `home_prices` with, for
+    each indicator, `<indicator>_share` (summed share of the ZCTA's area
+    served by systems in violation; can exceed 1 where service areas
+    overlap) and `<indicator>_any` (1 if any such system covers the ZCTA).
+    Zips without a crosswalk match get zeros.
+    """
+    home_prices = home_prices.reset_index(drop=True)
+    zcta_pos = weights.zcta_positions(home_prices[zip_col].to_numpy())
+    month_idx = home_prices["month"].to_numpy(dtype=np.int64) - 1
+    matched = zcta_pos >= 0
+
+    pws_codes = weights.pws_codes(violations[pws_col])
+    periods = violations["month_num"].to_numpy(dtype=np.int64) - 1
+
+    for col in indicator_cols:
+        flagged = violations[col].to_numpy() == 1
+        share, covered = weights.spread(pws_codes[flagged], periods[flagged], 12)
+
+        share_col = np.zeros(len(home_prices))
+        any_col = np.zeros(len(home_prices), dtype=np.int8)
+        share_col[matched] = share[zcta_pos[matched], month_idx[matched]]
+        any_col[matched] = covered[zcta_pos[matched], month_idx[matched]]
+        home_prices[f"{col}_share"] = share_col
+        home_prices[f"{col}_any"] = any_col
+
+    return home_prices
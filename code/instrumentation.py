@@ -0,0 +1,194 @@
+"""
+===============================================================================
+ Title: instrumentation.py
+ Description:
+     Lightweight timing and memory instrumentation for the pipeline stages.
+     A RunReport records nested, named spans (load, filter, reshape, ...)
+     with wall time, peak memory and rows in/out, and writes them to a JSON
+     run report in OUTPUT_OTHR_DIR/run-reports. Progress throttles progress
+     messages for long loops to one aggregate line every few seconds.
+
+     Usage:
+         report = RunReport("violations")
+         report.start("load")
+         ...
+         report.stop(rows_out=len(violations))
+         with report.span("reshape", rows_in=len(violations)) as span:
+             ...
+             span["rows_out"] = len(panel)
+         report.write()
+===============================================================================
+"""
+
+import os
+import sys
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+import config
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB (None if unknown)."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes on Linux
+        return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / 1024**2
+    return None
+
+
+# -----------------------------------------------------------------------------
+# Run Report
+# -----------------------------------------------------------------------------
+class RunReport:
+    """
+    Collects timed spans for one stage run. Spans nest: a span started while
+    another is open is recorded as its child (path "parent/child"). Python
+    heap peaks are tracked with tracemalloc when `trace_memory` is True
+    (defaults to config.PROFILE_TRACEMALLOC, as tracing slows pandas down).
+    """
+
+    def __init__(self, stage, trace_memory=None):
+        self.stage = stage
+        self.started_at = datetime.now()
+        self.spans = []
+        self._open = []
+        self._start = time.perf_counter()
+
+        if trace_memory is None:
+            trace_memory = getattr(config, "PROFILE_TRACEMALLOC", False)
+        self.trace_memory = trace_memory
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def start(self, name, rows_in=None):
+        """Open a span named `name` inside the currently open span, if any."""
+        if self.trace_memory:
+            # Carry the heap peak so far up to the enclosing span before resetting
+            if self._open:
+                parent = self._open[-1]
+                parent["_heap_peak"] = max(parent["_heap_peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        path = "/".join([s["name"] for s in self._open] + [name])
+        span = {
+            "name": name,
+            "path": path,
+            "depth": len(self._open),
+            "rows_in": rows_in,
+            "rows_out": None,
+            "_t0": time.perf_counter(),
+            "_heap_peak": 0,
+        }
+        self._open.append(span)
+        self.spans.append(span)
+        return span
+
+    def stop(self, rows_out=None):
+        """Close the innermost open span and record its time and memory."""
+        span = self._open.pop()
+        span["wall_s"] = round(time.perf_counter() - span.pop("_t0"), 4)
+        if rows_out is not None:
+            span["rows_out"] = rows_out
+
+        heap_peak = span.pop("_heap_peak")
+        if self.trace_memory:
+            heap_peak = max(heap_peak, tracemalloc.get_traced_memory()[1])
+            span["heap_peak_mb"] = round(heap_peak / 1024**2, 2)
+            if self._open:
+                parent = self._open[-1]
+                parent["_heap_peak"] = max(parent["_heap_peak"], heap_peak)
+
+        rss = peak_rss_mb()
+        span["rss_peak_mb"] = round(rss, 2) if rss is not None else None
+        return span
+
+    @contextmanager
+    def span(self, name, rows_in=None):
+        """Context manager form of start/stop; set span["rows_out"] inside."""
+        span = self.start(name, rows_in)
+        try:
+            yield span
+        finally:
+            self.stop()
+
+    def to_dict(self):
+        """Report contents, with spans in the order they were started."""
+        return {
+            "stage": self.stage,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "total_wall_s": round(time.perf_counter() - self._start, 4),
+            "rss_peak_mb": peak_rss_mb(),
+            "spans": self.spans,
+        }
+
+    def write(self, output_dir=None):
+        """Close any open spans, print a summary and save the JSON report."""
+        while self._open:
+            self.stop()
+
+        if output_dir is None:
+            output_dir = os.path.join(config.OUTPUT_OTHR_DIR, "run-reports")
+        os.makedirs(output_dir, exist_ok=True)
+
+        report = self.to_dict()
+        stamp = self.started_at.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(output_dir, f"{self.stage}-{stamp}.json")
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+        print(f"\nRun report for {self.stage} ({report['total_wall_s']:,.1f}s):")
+        for span in report["spans"]:
+            rows = "" if span["rows_out"] is None else f"  rows out: {span['rows_out']:,}"
+            print(f"  {'  ' * span['depth']}{span['name']:<20} {span['wall_s']:>9,.2f}s{rows}")
+        print(f"Saved to {path}")
+        return path
+
+
+# -----------------------------------------------------------------------------
+# Throttled Progress
+# -----------------------------------------------------------------------------
+class Progress:
+    """
+    Aggregate progress for long loops. Call update(n) as work completes;
+    a single status line is printed at most every `interval` seconds. `total`
+    may be None when the amount of work is not known up front.
+    """
+
+    def __init__(self, total, label, interval=5.0):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self._t0 = time.perf_counter()
+        self._last = self._t0
+
+    def update(self, n=1):
+        self.done += n
+        now = time.perf_counter()
+        finished = self.total is not None and self.done >= self.total
+        if now - self._last >= self.interval or finished:
+            self._last = now
+            elapsed = now - self._t0
+            rate = self.done / elapsed if elapsed > 0 else 0
+            if self.total is None:
+                print(f"{self.label}: {self.done:,} ({rate:,.1f}/s)")
+            else:
+                print(f"{self.label}: {self.done:,}/{self.total:,} "
+                      f"({self.done / max(self.total, 1):.0%}, {rate:,.1f}/s)")
@@ -0,0 +1,180 @@
+"""
+===============================================================================
+ Title: keys.py
+ Description:
+     Stable integer keys for the IDs shared across panels: water system IDs
+     (PWS ID / SABL_PWSID) and ZCTAs / zip codes (ZCTA5CE00, ZCTA5CE10,
+     zip_code). Each kind of ID has a dictionary persisted in
+     PROCESSED_DATA_DIR that only ever grows, so a key means the same ID in
+     every panel and every run, and groupbys, isin checks and joins can hash
+     int32 keys instead of Python strings. IDs are normalized in one place
+     first; in particular zip codes read as numbers get their leading zeros
+     back.
+
+     Usage:
+         violations["pws_key"] = encode_pws(violations["PWS ID"])
+         panel["zcta_key"] = encode_zcta(panel["zip_code"])
+===============================================================================
+"""
+
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+
+import config
+
+
+# -----------------------------------------------------------------------------
+# Normalization
+# -----------------------------------------------------------------------------
+def normalize_zip(values):
+    """
+    Zip codes / ZCTAs as 5-character strings, whether given as numbers
+    (90001, 1001.0) or text (" 01001", "01001-1234"). Missing values stay
+    missing.
+    """
+    values = pd.Series(values)
+    text = values.astype("string").str.strip()
+    # Numbers read from CSV may come back as floats ("1001.0")
+    text = text.str.replace(r"\.0+$", "", regex=True).str.slice(0, 5)
+    return text.str.zfill(5).astype(object).where(values.notna(), None).to_numpy()
+
+
+def normalize_pws_id(values):
+    """Water system IDs as upper-case strings without surrounding spaces."""
+    values = pd.Series(values)
+    text = values.astype("string").str.strip().str.upper()
+    return text.astype(object).where(values.notna(), None).to_numpy()
+
+
+# -----------------------------------------------------------------------------
+# Persisted Key Dictionaries
+# -----------------------------------------------------------------------------
+class KeyDictionary:
+    """
+    Append-only mapping between IDs of one kind and int32 keys (their
+    position in the dictionary). Saved as `keys-<kind>.json` in processed
+    data. New IDs are added under a lock file, after re-reading the saved
+    dictionary, so stages running in parallel never assign a key twice.
+    """
+
+    def __init__(self, kind, normalize):
+        self.kind = kind
+        self.normalize = normalize
+        self.path = os.path.join(config.PROCESSED_DATA_DIR, f"keys-{kind}.json")
+        self._load()
+
+    def _load(self):
+        ids = []
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                ids = json.load(f)
+        self.ids = pd.Index(ids, dtype=object)
+
+    def _lock(self, timeout=60):
+        lock_path = self.path + ".lock"
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        start = time.monotonic()
+        while True:
+            try:
+                return os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY), lock_path
+            except FileExistsError:
+                if time.monotonic() - start > timeout:
+                    raise TimeoutError(f"Could not lock {lock_path}; remove it if no run is active")
+                time.sleep(0.05)
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(list(self.ids), f)
+        os.replace(tmp_path, self.path)
+
+    def _add(self, new_ids):
+        fd, lock_path = self._lock()
+        try:
+            self._load()
+            new_ids = [i for i in new_ids if i not in self.ids]
+            if new_ids:
+                self.ids = self.ids.append(pd.Index(new_ids, dtype=object))
+                self._save()
+        finally:
+            os.close(fd)
+            os.remove(lock_path)
+
+    def merge(self, saved_path):
+        """
+        Merge in a saved copy of the dictionary (e.g. from the stage cache).
+        Keys are positions, so this only works if one of the two extends the
+        other; returns False, leaving the dictionary unchanged, if they give
+        some key to different IDs.
+        """
+        with open(saved_path) as f:
+            saved = json.load(f)
+        fd, lock_path = self._lock()
+        try:
+            self._load()
+            current = list(self.ids)
+            n = min(len(current), len(saved))
+            if current[:n] != saved[:n]:
+                return False
+            if len(saved) > len(current):
+                self.ids = pd.Index(saved, dtype=object)
+                self._save()
+            return True
+        finally:
+            os.close(fd)
+            os.remove(lock_path)
+
+    def encode(self, values, add=True):
+        """
+        int32 keys of `values` (normalized first). Unseen IDs are added to
+        the dictionary when `add` is True and get -1 otherwise, as do
+        missing values.
+        """
+        values = self.normalize(values)
+        codes = self.ids.get_indexer(values)
+
+        unseen = (codes < 0) & pd.notna(values)
+        if add and unseen.any():
+            self._add(sorted(set(values[unseen])))
+            codes = self.ids.get_indexer(values)
+
+        return codes.astype(np.int32)
+
+    def decode(self, keys):
+        """IDs for an array of keys (None for -1)."""
+        keys = np.asarray(keys)
+        ids = self.ids.to_numpy()[np.clip(keys, 0, None)] if len(self.ids) else np.full(len(keys), None)
+        return np.where(keys >= 0, ids, None)
+
+    def categorical(self, keys):
+        """IDs for `keys` as a Categorical whose codes are the keys."""
+        return pd.Categorical.from_codes(np.asarray(keys), categories=self.ids)
+
+
+# Normalization of each kind of ID with a key dictionary
+KEY_KINDS = {"pws": normalize_pws_id, "zcta": normalize_zip}
+
+
+def key_dictionary(kind):
+    return KeyDictionary(kind, KEY_KINDS[kind])
+
+
+def pws_keys():
+    return key_dictionary("pws")
+
+
+def zcta_keys():
+    return key_dictionary("zcta")
+
+
+def encode_pws(values, add=True):
+    """int32 keys for water system IDs (see KeyDictionary.encode)."""
+    return pws_keys().encode(values, add)
+
+
+def encode_zcta(values, add=True):
+    """int32 keys for zip codes / ZCTAs (see KeyDictionary.encode)."""
+    return zcta_keys().encode(values, add)
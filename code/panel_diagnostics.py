@@ -0,0 +1,101 @@
+"""
+===============================================================================
+ Title: panel_diagnostics.py
+ Description:
+     Per-entity coverage diagnostics for monthly panels (zip codes in the
+     home price panel, water systems in the violations panel). Works on an
+     entity x period matrix with vectorized NumPy reductions and returns one
+     summary row per entity, instead of broadcasting counts back onto every
+     row of the long panel.
+===============================================================================
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def coverage_summary(observed, entities, periods, entity_name="entity"):
+    """
+    Summarize which periods are observed for each entity.
+
+    `observed` is a boolean (n_entities x n_periods) matrix with periods in
+    time order. Returns a DataFrame with one row per entity containing the
+    entity ID (column `entity_name`) and:
+        n_periods       number of periods in the panel
+        n_observed      number of observed periods
+        n_missing       number of unobserved periods
+        coverage        share of periods observed
+        first_observed  first observed period (NaT/NaN if never observed)
+        last_observed   last observed period
+        n_gaps          number of unobserved runs between first and last
+        longest_gap     length of the longest such run (0 if none)
+    """
+    observed = np.asarray(observed, dtype=bool)
+    periods = pd.Index(periods)
+    n_entities, n_periods = observed.shape
+
+    n_observed = observed.sum(axis=1)
+    any_observed = n_observed > 0
+    first_idx = np.where(any_observed, observed.argmax(axis=1), -1)
+    last_idx = np.where(any_observed, n_periods - 1 - observed[:, ::-1].argmax(axis=1), -1)
+
+    # Treat periods before the first / after the last observation as observed,
+    # so every remaining unobserved run is an internal gap
+    cols = np.arange(n_periods)
+    inside = (cols >= first_idx[:, None]) & (cols <= last_idx[:, None])
+    filled = observed | ~inside
+
+    # Find gap runs across all entities at once on the flattened matrix, with
+    # an observed sentinel column so runs never cross entity boundaries
+    padded = np.hstack([filled, np.ones((n_entities, 1), dtype=bool)]).ravel()
+    edges = np.diff(np.concatenate([[0], (~padded).astype(np.int8)]))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+    run_entity = run_starts // (n_periods + 1)
+
+    n_gaps = np.bincount(run_entity, minlength=n_entities)
+    longest_gap = np.zeros(n_entities, dtype=np.int64)
+    np.maximum.at(longest_gap, run_entity, run_ends - run_starts)
+
+    def period_at(idx):
+        if n_periods == 0:
+            return np.full(n_entities, np.nan)
+        return periods.take(np.clip(idx, 0, None)).where(idx >= 0)
+
+    return pd.DataFrame({
+        entity_name: entities,
+        "n_periods": n_periods,
+        "n_observed": n_observed,
+        "n_missing": n_periods - n_observed,
+        "coverage": n_observed / n_periods if n_periods else np.nan,
+        "first_observed": period_at(first_idx),
+        "last_observed": period_at(last_idx),
+        "n_gaps": n_gaps,
+        "longest_gap": longest_gap,
+    })
+
+
+def wide_panel_diagnostics(values, entities, periods, entity_name="entity"):
+    """
+    Coverage summary for a wide panel (one row per entity, one column per
+    period), treating NaN cells as missing.
+    """
+    observed = ~np.isnan(np.asarray(values, dtype=float))
+    return coverage_summary(observed, entities, periods, entity_name)
+
+
+def long_panel_diagnostics(df, entity_col, period_col, observed=None):
+    """
+    Coverage summary for a long panel. Periods are all distinct values of
+    `period_col`. A cell is observed if a row exists for it and, when given,
+    the boolean Series `observed` is True for that row (e.g. any violation
+    in that month, or a non-missing price).
+    """
+    entity_codes, entities = pd.factorize(df[entity_col], sort=True)
+    period_codes, periods = pd.factorize(df[period_col], sort=True)
+
+    matrix = np.zeros((len(entities), len(periods)), dtype=bool)
+    flags = np.ones(len(df), dtype=bool) if observed is None else np.asarray(observed, dtype=bool)
+    matrix[entity_codes[flags], period_codes[flags]] = True
+
+    return coverage_summary(matrix, entities, periods, entity_col)
@@ -0,0 +1,162 @@
+"""
+===============================================================================
+ Title: panel_utils.py
+ Description:
+     Shared helpers for building monthly panels. Expands interval-level
+     records (e.g. SDWIS violations with a compliance begin and end date)
+     into one row per calendar month using NumPy month arithmetic instead of
+     row-by-row loops (optionally OR-ing bitmask flags per entity-month in
+     the same pass), and identifies records that were added or removed
+     between two versions of a source so panels can be updated in place.
+===============================================================================
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# -----------------------------------------------------------------------------
+# Interval -> Monthly Expansion
+# -----------------------------------------------------------------------------
+def _month_spans(df, start_col, end_col):
+    """
+    Month of each record's start (datetime64[M]) and the number of months it
+    covers (0 for missing or reversed dates).
+    """
+    start = np.asarray(df[start_col], dtype="datetime64[ns]").astype("datetime64[M]")
+    end = np.asarray(df[end_col], dtype="datetime64[ns]").astype("datetime64[M]")
+
+    valid = ~(np.isnat(start) | np.isnat(end))
+    n_months = np.zeros(len(df), dtype=np.int64)
+    n_months[valid] = (end[valid] - start[valid]).astype(np.int64) + 1
+    return start, np.clip(n_months, 0, None)
+
+
+def _repeat_months(start, n_months):
+    """Source row and month (as months since 1970) of every expanded row."""
+    row_idx = np.repeat(np.arange(len(n_months)), n_months)
+    first_out_row = np.cumsum(n_months) - n_months
+    offsets = np.arange(len(row_idx)) - np.repeat(first_out_row, n_months)
+    return row_idx, start[row_idx].astype(np.int64) + offsets
+
+
+def expand_to_monthly(df, start_col, end_col, columns=None, month_col="month"):
+    """
+    Expand each interval in `df` to one row per month it covers.
+
+    Start and end dates are floored to the beginning of their month, and each
+    record is repeated once for every month from start to end (inclusive).
+    Records with a missing date or an end before the start produce no rows.
+    Only `columns` are carried into the output (all columns if None); the
+    month column is appended as datetime64[ns] month-start values.
+    """
+    if columns is None:
+        columns = list(df.columns)
+
+    # Source row for every output row, plus its month
+    start, n_months = _month_spans(df, start_col, end_col)
+    row_idx, months = _repeat_months(start, n_months)
+
+    expanded = df[columns].iloc[row_idx].reset_index(drop=True)
+    expanded[month_col] = months.astype("datetime64[M]").astype("datetime64[ns]")
+
+    return expanded
+
+
+def expand_flags_to_monthly(df, entity_col, start_col, end_col, flag_col, month_col="month"):
+    """
+    Expand each interval to the months it covers and OR together the integer
+    bitmask `flag_col` of all records covering the same entity and month, in
+    one pass over NumPy arrays (no expanded DataFrame or groupby).
+
+    Returns one row per (entity, month) covered by at least one record, with
+    `entity_col`, `month_col` (datetime64[ns] month starts) and `flag_col`,
+    sorted by entity and month.
+    """
+    start, n_months = _month_spans(df, start_col, end_col)
+    row_idx, months = _repeat_months(start, n_months)
+    entity_codes, entities = pd.factorize(df[entity_col], sort=True)
+
+    flags = np.asarray(df[flag_col])[row_idx]
+    if len(months) == 0:
+        return pd.DataFrame({
+            entity_col: np.asarray(entities)[:0],
+            month_col: np.empty(0, dtype="datetime64[ns]"),
+            flag_col: flags,
+        })
+
+    # One integer per entity-month cell; sort, then OR each run of equal cells
+    first_month = months.min()
+    n_periods = months.max() - first_month + 1
+    cells = entity_codes[row_idx].astype(np.int64) * n_periods + (months - first_month)
+    order = np.argsort(cells, kind="stable")
+    cells = cells[order]
+    run_starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+
+    cell_flags = np.bitwise_or.reduceat(flags[order], run_starts)
+    cells = cells[run_starts]
+
+    return pd.DataFrame({
+        entity_col: np.asarray(entities)[cells // n_periods],
+        month_col: (cells % n_periods + first_month).astype("datetime64[M]").astype("datetime64[ns]"),
+        flag_col: cell_flags,
+    })
+
+
+# -----------------------------------------------------------------------------
+# Sparse -> Dense Panels
+# -----------------------------------------------------------------------------
+def densify_panel(sparse, entity_col, period_col, value_cols, entities, periods,
+                  fill_value=0, dtype=np.int8):
+    """
+    Build the full entity x period panel from a sparse table that only holds
+    the (entity, period) cells with data, e.g. PWS-months with a violation.
+
+    The grid is laid out with NumPy (entity-major, periods in the given order)
+    rather than a list of tuples, `value_cols` are scattered into it by
+    position instead of merged, and cells missing from `sparse` get
+    `fill_value`. The entity column is categorical to keep the panel compact.
+    """
+    entities = pd.Index(entities)
+    periods = pd.Index(periods)
+    n_entities, n_periods = len(entities), len(periods)
+
+    entity_idx = entities.get_indexer(sparse[entity_col])
+    period_idx = periods.get_indexer(sparse[period_col])
+    in_grid = (entity_idx >= 0) & (period_idx >= 0)
+    cell = entity_idx[in_grid] * n_periods + period_idx[in_grid]
+
+    panel = pd.DataFrame({
+        entity_col: pd.Categorical.from_codes(
+            np.repeat(np.arange(n_entities), n_periods), categories=entities
+        ),
+        period_col: np.tile(periods.to_numpy(), n_entities),
+    })
+    for col in value_cols:
+        values = np.full(n_entities * n_periods, fill_value, dtype=dtype)
+        values[cell] = sparse[col].to_numpy()[in_grid]
+        panel[col] = values
+
+    return panel
+
+
+# -----------------------------------------------------------------------------
+# Record Changes Between Releases
+# -----------------------------------------------------------------------------
+def record_digests(df, columns):
+    """
+    64-bit hash of the values in `columns` for each row of `df`, as signed
+    integers so they round-trip through CSV as well as Parquet.
+    """
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy().view(np.int64)
+
+
+def diff_records(current, previous, digest_col="record_digest"):
+    """
+    Records of `current` whose digest is not in `previous` (added or changed)
+    and records of `previous` whose digest is not in `current` (removed or
+    changed). A changed record appears once in each.
+    """
+    added = current[~current[digest_col].isin(previous[digest_col])]
+    removed = previous[~previous[digest_col].isin(current[digest_col])]
+    return added, removed
@@ -0,0 +1,514 @@
+"""
+===============================================================================
+ Title: pipeline.py
+ Description:
+     Runs the 01-data-cleaning-* stages and the 02 exposure panel stage with
+     declared inputs, outputs and dependencies.
+     Each stage is fingerprinted from the contents of its input files, its
+     script, its parameters and the command-line options it runs with (as
+     parsed by the script's parse_args, which also decide which files it
+     writes); stages whose fingerprint is already in the cache are skipped
+     and their outputs (including any partitions appended to their tables)
+     restored from the cache instead of being recomputed.
+     The integer key dictionaries (see keys.py) are cached with the stages
+     that add IDs to them, and merged back when those stages are restored
+     only if they give every key to the same ID as the dictionaries on disk;
+     otherwise the stage is rerun.
+     Stages run as soon as the stages they depend on are done, so
+     independent stages (home prices and violations) run at the same time
+     in separate worker processes. Each stage script's work is in its
+     main(argv) function, which is called here.
+
+     Usage (from any directory):
+         python pipeline.py                      # run stages that are out of date
+         python pipeline.py --force              # rerun every stage
+         python pipeline.py --stages mapping     # mapping and the stages it needs
+         python pipeline.py --jobs 1             # one stage at a time, in this process
+         python pipeline.py --data-dir /data     # override config.DATA_DIR
+         python pipeline.py --workers 16         # other options go to every stage
+===============================================================================
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import importlib
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import config
+import storage
+from zillow_reshape import home_price_panel_name
+from exposure import exposure_panel_name
+from crosswalk import fast_mode_suffix
+from digests import file_digest, load_hash_index, save_hash_index
+from keys import key_dictionary
+
+
+# -----------------------------------------------------------------------------
+# Stage Definitions
+# -----------------------------------------------------------------------------
+def _shapefile(path):
+    """All sidecar files (.shp, .dbf, .shx, .prj, ...) making up a shapefile."""
+    return sorted(glob.glob(os.path.splitext(path)[0] + ".*"))
+
+
+def _table_files(name):
+    """A processed table's primary file plus any partitions appended to it."""
+    return [
+        storage.table_paths(name)[0],
+        *sorted(glob.glob(os.path.join(storage.partition_dir(name), "*"))),
+    ]
+
+
+def _key_files(kinds):
+    """Saved key dictionaries (keys-pws.json, ...) of the given kinds."""
+    return [key_dictionary(kind).path for kind in kinds]
+
+
+def _crosswalk_outputs(options):
+    """Files written by the mapping stage (fast-mode runs write their own)."""
+    suffix = fast_mode_suffix(options.simplify, options.grid_size)
+    return [
+        *storage.table_paths(f"CA-PWS-to-ZTCA-2000-crosswalk{suffix}"),
+        *storage.geo_table_paths(f"CA-PWS-to-ZTCA-2000-crosswalk{suffix}-SF"),
+        *storage.table_paths(f"CA-PWS-to-ZTCA-2010-crosswalk{suffix}"),
+        *storage.geo_table_paths(f"CA-PWS-to-ZTCA-2010-crosswalk{suffix}-SF"),
+        storage.processed_path(f"CA-PWS-to-ZTCA-crosswalk{suffix}-state", "json"),
+    ]
+
+
+STAGES = [
+    {
+        "name": "home-prices",
+        "script": "01-data-cleaning-home-prices.py",
+        "modules": [
+            "zillow_reshape.py", "panel_diagnostics.py", "storage.py", "instrumentation.py",
+            "keys.py",
+        ],
+        "inputs": lambda options: [
+            os.path.join(
+                config.RAW_HOME_PRICE_DIR,
+                "Zip_zhvi_uc_sfrcondo_tier_0.33_0.67_sm_sa_month.csv"
+            ),
+        ],
+        "outputs": lambda options: storage.table_paths(home_price_panel_name(config.ZILLOW_STATES)),
+        "partition_dirs": lambda options: [
+            storage.partition_dir(home_price_panel_name(config.ZILLOW_STATES)),
+        ],
+        # Key dictionaries the stage adds IDs to, cached with its outputs
+        "key_dictionaries": ["zcta"],
+        "params": lambda: {
+            "ZILLOW_STATES": config.ZILLOW_STATES,
+            "PROCESSED_FORMAT": config.PROCESSED_FORMAT,
+        },
+    },
+    {
+        "name": "violations",
+        "script": "01-data-cleaning-violations-data.py",
+        "modules": [
+            "panel_utils.py", "panel_diagnostics.py", "sdwis_ingest.py", "storage.py",
+            "instrumentation.py", "keys.py", "violation_indicators.py", "digests.py",
+        ],
+        "inputs": lambda options: [
+            os.path.join(config.RAW_EPA_DIR, "Violation Report_20250308.xlsx"),
+        ],
+        "outputs": lambda options: [
+            *storage.table_paths("CA_monthly_violation_panel"),
+            *storage.table_paths("CA_monthly_violation_panel-records"),
+            storage.processed_path("CA_monthly_violation_panel-indicators", "json"),
+        ],
+        "partition_dirs": lambda options: [storage.partition_dir("CA_monthly_violation_panel")],
+        "key_dictionaries": ["pws"],
+        "params": lambda: {
+            "VIOLATION_INDICATOR_RULES": config.VIOLATION_INDICATOR_RULES,
+            "PROCESSED_FORMAT": config.PROCESSED_FORMAT,
+        },
+    },
+    {
+        "name": "mapping",
+        "script": "01-data-cleaning-mapping-CWS-ZCTA.py",
+        "modules": [
+            "crosswalk.py", "spatial_cache.py", "storage.py", "instrumentation.py", "keys.py",
+            "digests.py", "violation_indicators.py",
+        ],
+        "depends_on": ["violations"],
+        # Options that don't change the outputs, left out of the fingerprint
+        "run_options": ["workers", "check_fast"],
+        "inputs": lambda options: [
+            *_table_files("CA_monthly_violation_panel"),
+            *_shapefile(os.path.join(
+                config.RAW_CWS_DIR,
+                "California_Drinking_Water_System_Area_Boundaries.shp"
+            )),
+            *_shapefile(os.path.join(
+                config.RAW_ZCTA_DIR, "ZCTA-2000", "tl_2010_06_zcta500.shp"
+            )),
+            *_shapefile(os.path.join(
+                config.RAW_ZCTA_DIR, "ZCTA-2010", "tl_2010_06_zcta510.shp"
+            )),
+        ],
+        "outputs": _crosswalk_outputs,
+        "key_dictionaries": ["pws", "zcta"],
+        "params": lambda: {
+            "CROSSWALK_ALL_PWS": config.CROSSWALK_ALL_PWS,
+            "VIOLATION_INDICATOR_RULES": config.VIOLATION_INDICATOR_RULES,
+            "CROSSWALK_INDICATORS": config.CROSSWALK_INDICATORS,
+            "PROCESSED_FORMAT": config.PROCESSED_FORMAT,
+            "GEO_EXPORT_FORMAT": config.GEO_EXPORT_FORMAT,
+        },
+    },
+    {
+        "name": "exposure",
+        "script": "02-create-ZCTA-exposure-panel.py",
+        "modules": [
+            "exposure.py", "zillow_reshape.py", "violation_indicators.py", "storage.py",
+            "instrumentation.py",
+        ],
+        "depends_on": ["home-prices", "violations", "mapping"],
+        "inputs": lambda options: [
+            *_table_files("CA_monthly_violation_panel"),
+            *_table_files(home_price_panel_name(config.ZILLOW_STATES)),
+            storage.table_paths(f"CA-PWS-to-ZTCA-{options.vintage}-crosswalk")[0],
+            # Joins the panels on their keys, so they must come from these
+            *_key_files(["pws", "zcta"]),
+        ],
+        "outputs": lambda options: storage.table_paths(
+            exposure_panel_name(options.vintage, options.min_coverage, options.indicators)
+        ),
+        "params": lambda: {
+            "VIOLATION_INDICATOR_RULES": config.VIOLATION_INDICATOR_RULES,
+            "ZILLOW_STATES": config.ZILLOW_STATES,
+            "PROCESSED_FORMAT": config.PROCESSED_FORMAT,
+        },
+    },
+]
+
+
+# -----------------------------------------------------------------------------
+# Fingerprinting
+# -----------------------------------------------------------------------------
+def _hash_index_file():
+    return os.path.join(config.CACHE_DIR, "file-hashes.json")
+
+
+def _load_hash_index():
+    return load_hash_index(_hash_index_file())
+
+
+def _save_hash_index(index):
+    save_hash_index(index, _hash_index_file())
+
+
+def stage_fingerprint(stage, options, hash_index=None):
+    """Digest of a stage's code, input file contents, parameters and options."""
+    parts = {
+        "code": [
+            file_digest(os.path.join(config.CODE_DIR, name), hash_index)
+            for name in [stage["script"], *stage.get("modules", [])]
+        ],
+        "inputs": [
+            [os.path.basename(path), file_digest(path, hash_index)]
+            for path in stage["inputs"](options)
+        ],
+        "params": stage["params"](),
+        "options": {
+            name: value for name, value in vars(options).items()
+            if name not in stage.get("run_options", [])
+        },
+    }
+    payload = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.sha256(payload).hexdigest()
+
+
+# -----------------------------------------------------------------------------
+# Stage Cache
+# -----------------------------------------------------------------------------
+def _entry_dir(stage, fingerprint):
+    return os.path.join(config.CACHE_DIR, stage["name"], fingerprint)
+
+
+def _partition_dirs(stage, options):
+    return stage["partition_dirs"](options) if "partition_dirs" in stage else []
+
+
+def _dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def restore_from_cache(stage, fingerprint, options, hash_index=None):
+    """Copy cached outputs back into place. Returns False on a cache miss."""
+    entry = _entry_dir(stage, fingerprint)
+    if not os.path.isdir(entry):
+        return False
+
+    outputs = stage["outputs"](options)
+    for path in [*outputs, *_key_files(stage.get("key_dictionaries", []))]:
+        cached = os.path.join(entry, os.path.basename(path))
+        if not os.path.exists(cached):
+            return False
+
+    # The cached outputs' keys are only valid if the dictionaries on disk
+    # agree with the ones they were made with
+    for kind in stage.get("key_dictionaries", []):
+        keys = key_dictionary(kind)
+        if not keys.merge(os.path.join(entry, os.path.basename(keys.path))):
+            print(f"[{stage['name']}] cached {kind} keys differ from {keys.path}, rerunning")
+            return False
+
+    for path in outputs:
+        cached = os.path.join(entry, os.path.basename(path))
+        # Skip the copy if the output on disk is already the cached version
+        up_to_date = (
+            os.path.exists(path)
+            and file_digest(path, hash_index) == file_digest(cached, hash_index)
+        )
+        if not up_to_date:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copy2(cached, path)
+
+    # Partitions appended by the cached run, if any, replace those on disk
+    for path in _partition_dirs(stage, options):
+        cached = os.path.join(entry, os.path.basename(path))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        if os.path.isdir(cached):
+            shutil.copytree(cached, path)
+
+    # Mark entry as recently used for LRU eviction
+    os.utime(entry)
+    return True
+
+
+def store_in_cache(stage, fingerprint, options):
+    """Copy a stage's fresh outputs into the cache under its fingerprint."""
+    entry = _entry_dir(stage, fingerprint)
+    os.makedirs(entry, exist_ok=True)
+    for path in stage["outputs"](options):
+        shutil.copy2(path, os.path.join(entry, os.path.basename(path)))
+    # A dictionary is only saved once it has an ID in it
+    for path in _key_files(stage.get("key_dictionaries", [])):
+        if os.path.exists(path):
+            shutil.copy2(path, os.path.join(entry, os.path.basename(path)))
+    for path in _partition_dirs(stage, options):
+        cached = os.path.join(entry, os.path.basename(path))
+        if os.path.isdir(cached):
+            shutil.rmtree(cached)
+        if os.path.isdir(path):
+            shutil.copytree(path, cached)
+    os.utime(entry)
+
+
+def evict_cache(max_bytes=None):
+    """Remove least recently used cache entries until under `max_bytes`."""
+    if max_bytes is None:
+        max_bytes = config.CACHE_MAX_BYTES
+
+    entries = [
+        path for path in glob.glob(os.path.join(config.CACHE_DIR, "*", "*"))
+        if os.path.isdir(path)
+    ]
+    sizes = {path: _dir_size(path) for path in entries}
+    total = sum(sizes.values())
+
+    for path in sorted(entries, key=os.path.getmtime):
+        if total <= max_bytes:
+            break
+        print(f"Evicting cache entry {os.path.relpath(path, config.CACHE_DIR)}")
+        shutil.rmtree(path)
+        total -= sizes[path]
+
+
+# -----------------------------------------------------------------------------
+# Runner
+# -----------------------------------------------------------------------------
+def set_data_dirs(data_dir=None, project_dir=None):
+    """
+    Point config (and every path derived from it) at other data / project
+    directories. The overrides are set as environment variables, so stage
+    worker processes see them too.
+    """
+    if data_dir is not None:
+        os.environ["WQHP_DATA_DIR"] = os.path.abspath(data_dir)
+    if project_dir is not None:
+        os.environ["WQHP_PROJECT_DIR"] = os.path.abspath(project_dir)
+    importlib.reload(config)
+
+
+def select_stages(names=None):
+    """The named stages plus every stage they depend on, in STAGES order."""
+    if not names:
+        return list(STAGES)
+
+    by_name = {stage["name"]: stage for stage in STAGES}
+    unknown = set(names) - set(by_name)
+    if unknown:
+        raise ValueError(f"Unknown stages: {sorted(unknown)} (choose from {list(by_name)})")
+
+    needed, todo = set(), list(names)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(by_name[name].get("depends_on", []))
+    return [stage for stage in STAGES if stage["name"] in needed]
+
+
+def load_stage(stage):
+    """
+    A stage script as a module, with its parse_args(argv) and main(argv)
+    functions. Stage scripts are loaded from their file, as their names
+    (01-..., 02-...) can't be imported as modules.
+    """
+    if config.CODE_DIR not in sys.path:
+        sys.path.insert(0, config.CODE_DIR)
+    module_name = "stage_" + stage["name"].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(
+        module_name, os.path.join(config.CODE_DIR, stage["script"])
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def stage_options(stage, argv=None):
+    """The options a stage runs with for `argv`, including config defaults."""
+    return load_stage(stage).parse_args(argv)
+
+
+def run_stage(stage, argv=None):
+    """Run a stage's main function; returns its wall time in seconds."""
+    module = load_stage(stage)
+    start = time.perf_counter()
+    module.main(argv)
+    return time.perf_counter() - start
+
+
+def _run_stage_by_name(name, argv):
+    """Worker process entry point (stages themselves can't be pickled)."""
+    return run_stage(next(stage for stage in STAGES if stage["name"] == name), argv)
+
+
+def run_pipeline(stages=None, force=False, jobs=1, argv=None):
+    """
+    Run stages in dependency order, skipping any whose fingerprint is cached.
+
+    A stage starts as soon as every stage it depends on is done (dependencies
+    outside `stages` are assumed to be up to date). With `jobs` > 1 stages
+    run in a pool of that many worker processes, so independent stages run at
+    the same time; with 1 they run one at a time in this process. `argv` is
+    passed to each stage's main function, and the options each stage parses
+    from it are part of its fingerprint (None means no options, not
+    sys.argv). Stages that depend on a failed stage are not run, and a
+    RuntimeError is raised once the others finish.
+    """
+    stages = STAGES if stages is None else stages
+    # Stages parse sys.argv when given None; fingerprint and run them the same way
+    argv = [] if argv is None else argv
+    names = {stage["name"] for stage in stages}
+    hash_index = _load_hash_index()
+
+    pending = list(stages)
+    done, failed = set(), {}
+    running = {}
+
+    executor = None
+    if jobs > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=jobs, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def finish(stage, fingerprint, options, seconds):
+        print(f"[{stage['name']}] finished in {seconds:,.1f}s")
+        store_in_cache(stage, fingerprint, options)
+        _save_hash_index(hash_index)
+        done.add(stage["name"])
+
+    try:
+        while pending or running:
+            # Start (or restore from the cache) every stage that is ready,
+            # repeating as restored or serial stages make others ready
+            started = True
+            while started:
+                started = False
+                for stage in list(pending):
+                    waiting_on = [
+                        dep for dep in stage.get("depends_on", []) if dep in names and dep not in done
+                    ]
+                    if waiting_on:
+                        continue
+                    pending.remove(stage)
+                    started = True
+
+                    options = stage_options(stage, argv)
+                    fingerprint = stage_fingerprint(stage, options, hash_index)
+                    if not force and restore_from_cache(stage, fingerprint, options, hash_index):
+                        print(f"[{stage['name']}] unchanged, using cached outputs "
+                              f"({fingerprint[:12]})")
+                        done.add(stage["name"])
+                        continue
+
+                    print(f"[{stage['name']}] running {stage['script']}...")
+                    if executor is None:
+                        finish(stage, fingerprint, options, run_stage(stage, argv))
+                    else:
+                        future = executor.submit(_run_stage_by_name, stage["name"], argv)
+                        running[future] = (stage, fingerprint, options)
+
+            # Stages left waiting on a failed stage can never start
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, fingerprint, options = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as error:
+                    print(f"[{stage['name']}] failed: {error!r}")
+                    failed[stage["name"]] = error
+                    continue
+                finish(stage, fingerprint, options, seconds)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    _save_hash_index(hash_index)
+    evict_cache()
+
+    if failed:
+        not_run = [stage["name"] for stage in pending]
+        error = RuntimeError(f"Stages failed: {sorted(failed)}; not run: {not_run}")
+        raise error from next(iter(failed.values()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the data cleaning pipeline. Other options are passed to every stage."
+    )
+    parser.add_argument(
+        "--stages", nargs="+", help="stages to run, with the stages they depend on (default: all)"
+    )
+    parser.add_argument("--force", action="store_true", help="rerun every stage")
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count() or 1,
+        help="stages to run at the same time in worker processes (1 = one by one, in this process)"
+    )
+    parser.add_argument("--data-dir", help="override config.DATA_DIR (raw, processed data and cache)")
+    parser.add_argument("--project-dir", help="override config.PROJECT_DIR (outputs)")
+    args, stage_argv = parser.parse_known_args()
+
+    if args.data_dir or args.project_dir:
+        set_data_dirs(args.data_dir, args.project_dir)
+
+    run_pipeline(select_stages(args.stages), force=args.force, jobs=args.jobs, argv=stage_argv)
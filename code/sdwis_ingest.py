@@ -0,0 +1,134 @@
+"""
+===============================================================================
+ Title: sdwis_ingest.py
+ Description:
+     Fast loading of the EPA SDWIS violation report. The Excel export is
+     converted once into a Parquet file in its own cache entry directory,
+     keyed on the SHA-256 of the source workbook and on the conversion
+     settings, keeping only the columns and rows the violations panel uses.
+     Later runs read the cached Parquet file instead of parsing the workbook
+     again.
+===============================================================================
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import importlib.util
+import pandas as pd
+
+import config
+from digests import file_digest, load_hash_index, save_hash_index
+
+
+# Bump when the conversion code changes, so old entries are not reused
+SDWIS_CACHE_VERSION = 1
+
+
+# Columns used by 01-data-cleaning-violations-data.py
+SDWIS_COLUMNS = [
+    "PWS ID",
+    "PWS Type Code",
+    "Public Notification Tier",
+    "Compliance Status",
+    "Population Served Count",
+    "Compliance Period Begin Date",
+    "Compliance Period End Date",
+    "RTC Date",
+    "Contaminant Name",
+]
+
+# Read as strings (the rest are inferred from the workbook)
+SDWIS_DTYPES = {
+    "PWS ID": str,
+    "PWS Type Code": str,
+    "Compliance Status": str,
+    "Population Served Count": str,
+    "Contaminant Name": str,
+}
+
+SDWIS_DATE_COLUMNS = [
+    "Compliance Period Begin Date",
+    "Compliance Period End Date",
+    "RTC Date",
+]
+
+# Rows kept during conversion: closed tier 1/2 violations at community systems
+SDWIS_PWS_TYPES = ["CWS"]
+SDWIS_NOTIFICATION_TIERS = [1, 2]
+SDWIS_EXCLUDED_STATUSES = ["Open"]
+
+# Number of header rows above the column names in the SDWIS export
+SDWIS_HEADER_ROWS = 4
+
+
+def _excel_engine():
+    """Use the Rust-based calamine reader if installed, otherwise openpyxl."""
+    if importlib.util.find_spec("python_calamine") is not None:
+        return "calamine"
+    return "openpyxl"
+
+
+def convert_violation_report(excel_path, cache_dir):
+    """Read the needed columns/rows of the SDWIS workbook and save as a cache entry."""
+    violations = pd.read_excel(
+        excel_path,
+        skiprows=SDWIS_HEADER_ROWS,
+        usecols=SDWIS_COLUMNS,
+        dtype=SDWIS_DTYPES,
+        engine=_excel_engine(),
+    )
+    n_raw = len(violations)
+
+    violations = violations[
+        (violations["PWS Type Code"].isin(SDWIS_PWS_TYPES)) &
+        (violations["Public Notification Tier"].isin(SDWIS_NOTIFICATION_TIERS)) &
+        (~violations["Compliance Status"].isin(SDWIS_EXCLUDED_STATUSES))
+    ].reset_index(drop=True)
+
+    for col in SDWIS_DATE_COLUMNS:
+        violations[col] = pd.to_datetime(violations[col])
+
+    # Write to a temporary directory first so an interrupted run leaves no
+    # partial entry; another process may have finished the same entry first
+    tmp_dir = f"{cache_dir}.tmp-{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    violations.to_parquet(
+        os.path.join(tmp_dir, "violations.parquet"),
+        engine="pyarrow", compression="zstd", index=False
+    )
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir)
+    print(f"Converted {n_raw:,} raw violations ({len(violations):,} kept) to {cache_dir}")
+
+
+def load_violation_report(excel_path):
+    """
+    Load the filtered SDWIS violation report, converting the workbook to a
+    cached Parquet file the first time a given version of it is seen.
+    """
+    # Key on the workbook contents (its digest kept in a hash index, so an
+    # unchanged workbook is not read again) and on the conversion settings
+    index_path = os.path.join(config.CACHE_DIR, "sdwis", "file-hashes.json")
+    hash_index = load_hash_index(index_path)
+    saved_index = {key: dict(entry) for key, entry in hash_index.items()}
+    workbook_digest = file_digest(excel_path, hash_index)
+    if hash_index != saved_index:
+        save_hash_index(hash_index, index_path)
+
+    settings = json.dumps([
+        SDWIS_CACHE_VERSION, SDWIS_HEADER_ROWS, SDWIS_COLUMNS, SDWIS_DTYPES,
+        SDWIS_DATE_COLUMNS, SDWIS_PWS_TYPES, SDWIS_NOTIFICATION_TIERS, SDWIS_EXCLUDED_STATUSES,
+    ], default=str)
+    settings_digest = hashlib.sha256(settings.encode()).hexdigest()
+    cache_dir = os.path.join(config.CACHE_DIR, "sdwis", f"{workbook_digest[:32]}-{settings_digest[:8]}")
+
+    if not os.path.isdir(cache_dir):
+        convert_violation_report(excel_path, cache_dir)
+
+    # Mark entry as recently used for LRU eviction
+    os.utime(cache_dir)
+    return pd.read_parquet(os.path.join(cache_dir, "violations.parquet"), engine="pyarrow")
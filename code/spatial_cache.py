@@ -0,0 +1,205 @@
+"""
+===============================================================================
+ Title: spatial_cache.py
+ Description:
+     Fast loading of the shapefiles used by the mapping stage. Each layer is
+     read and reprojected once, then saved in the cache directory (keyed on
+     the SHA-256 of the shapefile's files and the target CRS) as a blob of
+     WKB geometries with an offsets array, a bounds array and a Parquet file
+     of the attribute columns. Later runs memory-map the blob and arrays
+     instead of parsing and reprojecting the shapefile again. Geometries are
+     decoded and the spatial index built lazily, at most once per layer per
+     process; worker processes open the same files read-only, so the
+     operating system shares their pages.
+
+     Usage:
+         zcta = load_layer(shapefile, crs="EPSG:3310")
+         zcta.geoms, zcta.tree, zcta["ZCTA5CE10"], zcta.to_geodataframe()
+===============================================================================
+"""
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+import config
+from digests import file_digest, load_hash_index, save_hash_index
+
+
+# Bump when the cache layout changes, so old entries are not reused
+LAYER_CACHE_VERSION = 1
+
+
+# -----------------------------------------------------------------------------
+# Building the Cache
+# -----------------------------------------------------------------------------
+def layer_cache_dir(path, crs):
+    """
+    Cache directory for shapefile `path` reprojected to `crs`. The digests
+    of the shapefile's files are kept in a hash index, so files whose size
+    and modification time are unchanged are not read again.
+    """
+    index_path = os.path.join(config.CACHE_DIR, "layers", "file-hashes.json")
+    hash_index = load_hash_index(index_path)
+    saved_index = {key: dict(entry) for key, entry in hash_index.items()}
+
+    digest = hashlib.sha256()
+    for source in sorted(glob.glob(os.path.splitext(path)[0] + ".*")):
+        digest.update(os.path.basename(source).encode())
+        digest.update(file_digest(source, hash_index).encode())
+    if hash_index != saved_index:
+        save_hash_index(hash_index, index_path)
+    digest.update(json.dumps([str(crs), LAYER_CACHE_VERSION]).encode())
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(config.CACHE_DIR, "layers", f"{stem}-{digest.hexdigest()[:32]}")
+
+
+def build_layer_cache(path, cache_dir, crs):
+    """Read and reproject a shapefile and save it as a layer cache entry."""
+    layer = gpd.read_file(path).to_crs(crs)
+    geoms = np.asarray(layer.geometry.array)
+    # Missing geometries are stored as zero-length WKB
+    wkb = [b"" if g is None else g for g in shapely.to_wkb(geoms)]
+    offsets = np.concatenate([[0], np.cumsum([len(g) for g in wkb])]).astype(np.int64)
+
+    # Write to a temporary directory first so an interrupted run leaves no
+    # partial entry; another process may have finished the same entry first
+    tmp_dir = f"{cache_dir}.tmp-{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    with open(os.path.join(tmp_dir, "geometry.wkb"), "wb") as f:
+        f.write(b"".join(wkb))
+    np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(tmp_dir, "bounds.npy"), shapely.bounds(geoms))
+    pd.DataFrame(layer.drop(columns=layer.geometry.name)).to_parquet(
+        os.path.join(tmp_dir, "attributes.parquet"), engine="pyarrow", index=False
+    )
+    with open(os.path.join(tmp_dir, "layer.json"), "w") as f:
+        json.dump({"source": path, "crs": layer.crs.to_string(), "n": len(layer)}, f)
+
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir)
+    print(f"Cached {len(layer):,} geometries from {os.path.basename(path)} to {cache_dir}")
+
+
+# -----------------------------------------------------------------------------
+# Memory-Mapped Layers
+# -----------------------------------------------------------------------------
+class SpatialLayer:
+    """
+    A cached layer, memory-mapped from its cache directory. Bounds and WKB
+    are read straight from the mapped files; `geoms` (the decoded Shapely
+    geometries) and `tree` (an STRtree over them) are built on first use.
+    Attribute columns are available as layer[column].
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, "layer.json")) as f:
+            meta = json.load(f)
+        self.crs = meta["crs"]
+        self.offsets = np.load(os.path.join(cache_dir, "offsets.npy"), mmap_mode="r")
+        self.bounds = np.load(os.path.join(cache_dir, "bounds.npy"), mmap_mode="r")
+
+        blob_path = os.path.join(cache_dir, "geometry.wkb")
+        if os.path.getsize(blob_path):
+            self._blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            self._blob = np.empty(0, dtype=np.uint8)
+
+        self._attributes = None
+        self._geoms = None
+        self._tree = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def attributes(self):
+        """Attribute columns as a DataFrame (read on first use)."""
+        if self._attributes is None:
+            self._attributes = pd.read_parquet(
+                os.path.join(self.cache_dir, "attributes.parquet"), engine="pyarrow"
+            )
+        return self._attributes
+
+    def __getitem__(self, column):
+        return self.attributes[column]
+
+    def wkb(self, positions=None):
+        """WKB of the geometries at `positions` (default: all), as bytes (None if missing)."""
+        if positions is None:
+            positions = range(len(self))
+        return [
+            self._blob[self.offsets[i]:self.offsets[i + 1]].tobytes() or None for i in positions
+        ]
+
+    def in_bbox(self, bbox):
+        """Positions of geometries whose bounds intersect (xmin, ymin, xmax, ymax)."""
+        xmin, ymin, xmax, ymax = bbox
+        b = self.bounds
+        return np.flatnonzero(
+            (b[:, 0] <= xmax) & (b[:, 2] >= xmin) & (b[:, 1] <= ymax) & (b[:, 3] >= ymin)
+        )
+
+    @property
+    def geoms(self):
+        """All geometries as a Shapely array (decoded on first use)."""
+        if self._geoms is None:
+            self._geoms = shapely.from_wkb(np.array(self.wkb(), dtype=object))
+        return self._geoms
+
+    @property
+    def tree(self):
+        """STRtree over the geometries (built on first use)."""
+        if self._tree is None:
+            self._tree = shapely.STRtree(self.geoms)
+        return self._tree
+
+    def to_geodataframe(self, positions=None):
+        """
+        The layer (or the rows at `positions`) as a GeoDataFrame. Only the
+        selected geometries are decoded if the layer's are not yet.
+        """
+        if positions is None:
+            return gpd.GeoDataFrame(self.attributes.copy(), geometry=self.geoms, crs=self.crs)
+        geoms = (
+            self._geoms[positions] if self._geoms is not None
+            else shapely.from_wkb(np.array(self.wkb(positions), dtype=object))
+        )
+        attributes = self.attributes.iloc[positions].reset_index(drop=True)
+        return gpd.GeoDataFrame(attributes, geometry=geoms, crs=self.crs)
+
+
+# Layers opened in this process, so each is decoded and indexed only once
+_open_layers = {}
+
+
+def open_layer(cache_dir):
+    """The SpatialLayer for a cache directory, shared within the process."""
+    if cache_dir not in _open_layers:
+        _open_layers[cache_dir] = SpatialLayer(cache_dir)
+    return _open_layers[cache_dir]
+
+
+def load_layer(path, crs="EPSG:3310"):
+    """
+    Shapefile `path` reprojected to `crs`, as a memory-mapped SpatialLayer.
+    The shapefile is only read and reprojected the first time a given
+    version of it is seen.
+    """
+    cache_dir = layer_cache_dir(path, crs)
+    if not os.path.isdir(cache_dir):
+        build_layer_cache(path, cache_dir, crs)
+
+    # Mark entry as recently used for LRU eviction of the cache
+    os.utime(cache_dir)
+    return open_layer(cache_dir)
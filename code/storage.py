@@ -0,0 +1,409 @@
+"""
+===============================================================================
+ Title: storage.py
+ Description:
+     Reads and writes the processed datasets in PROCESSED_DATA_DIR. Tables
+     are stored as compressed Parquet with categorical ID columns and real
+     date columns, and geometries as GeoParquet, so later stages reload them
+     without re-parsing text or re-inferring dtypes. CSV (and FlatGeobuf or
+     GeoJSON for geometries) can still be written as an export alongside, or
+     used as the primary format, via config.PROCESSED_FORMAT /
+     config.EXPORT_CSV / config.GEO_EXPORT_FORMAT.
+
+     Geometry tables can be read for a bounding box only: GeoParquet is
+     written in small row groups with a bbox covering column, so row groups
+     outside the box are skipped, and FlatGeobuf with its packed R-tree
+     spatial index, so only the matching features are decoded.
+
+     A table can also be extended with partitions (append_partition), e.g.
+     the months added by a new data release. Partitions are stored next to
+     the table in `name`.parts and merged in by read_table, with later rows
+     replacing earlier rows that have the same key.
+===============================================================================
+"""
+
+import os
+import json
+import shutil
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import config
+
+
+# ID columns stored as dictionary-encoded categoricals in Parquet
+CATEGORICAL_COLUMNS = [
+    "PWS ID", "SABL_PWSID", "ZCTA5CE00", "ZCTA5CE10", "zip_code", "city", "metro", "county_name"
+]
+
+PARQUET_COMPRESSION = "zstd"
+
+# Rows per GeoParquet row group. Smaller groups let bbox reads skip more of
+# the file; rows are in PWS ID order, which follows county, so neighbouring
+# overlaps mostly share row groups
+GEO_ROW_GROUP_SIZE = 5000
+
+
+# -----------------------------------------------------------------------------
+# Paths
+# -----------------------------------------------------------------------------
+def processed_path(name, ext):
+    """Full path of processed dataset `name` with file extension `ext`."""
+    return os.path.join(config.PROCESSED_DATA_DIR, f"{name}.{ext}")
+
+
+def table_paths(name):
+    """Files written by write_table for dataset `name` under current config."""
+    paths = [processed_path(name, config.PROCESSED_FORMAT)]
+    if config.EXPORT_CSV and config.PROCESSED_FORMAT != "csv":
+        paths.append(processed_path(name, "csv"))
+    return paths
+
+
+def geo_table_paths(name):
+    """Files written by write_geo_table for dataset `name` under current config."""
+    if config.PROCESSED_FORMAT == "csv":
+        return [processed_path(name, config.GEO_EXPORT_FORMAT)]
+    paths = [processed_path(name, "parquet")]
+    if config.EXPORT_CSV:
+        paths.append(processed_path(name, config.GEO_EXPORT_FORMAT))
+    return paths
+
+
+def partition_dir(name):
+    """Directory holding the appended partitions of table `name`."""
+    return processed_path(name, "parts")
+
+
+def _read_parquet_path(name, text_ext):
+    """
+    Parquet path to read for `name`, or None if the text version should be
+    read instead (Parquet missing, or CSV is the configured format and exists).
+    """
+    parquet_path = processed_path(name, "parquet")
+    text_exists = os.path.exists(processed_path(name, text_ext))
+    if not os.path.exists(parquet_path):
+        return None
+    if config.PROCESSED_FORMAT == "csv" and text_exists:
+        return None
+    return parquet_path
+
+
+# -----------------------------------------------------------------------------
+# Tables
+# -----------------------------------------------------------------------------
+def _encode_categoricals(df):
+    df = df.copy()
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns and df[col].dtype == object:
+            df[col] = df[col].astype("category")
+    return df
+
+
+def _write_table_files(df, paths):
+    for path in paths:
+        if path.endswith(".parquet"):
+            _encode_categoricals(df).to_parquet(
+                path, engine="pyarrow", compression=PARQUET_COMPRESSION, index=False
+            )
+        else:
+            df.to_csv(path, index=False)
+
+
+def write_table(df, name):
+    """
+    Save a processed table. Writes `name`.parquet (typed, compressed, with
+    categorical ID columns) and/or `name`.csv depending on config. Any
+    partitions appended to an earlier version of the table are removed.
+    """
+    _clear_partitions(name)
+    _write_table_files(df, table_paths(name))
+    return table_paths(name)[0]
+
+
+def read_table(name, columns=None, filters=None, parse_dates=None):
+    """
+    Load a processed table, reading only `columns` if given.
+
+    Parquet is used when available; `filters` (pyarrow filter expressions,
+    e.g. [("year", ">=", 2010)]) are pushed down into the Parquet read. If
+    only a CSV is available it is read instead, with `parse_dates` naming the
+    date columns to parse, and `filters` are applied after reading. Filters
+    on date columns of a CSV need those columns in `parse_dates`.
+    """
+    partitions = read_partition_manifest(name)
+    if partitions:
+        return _read_partitioned_table(name, partitions, columns, filters, parse_dates)
+
+    parquet_path = _read_parquet_path(name, "csv")
+    if parquet_path is not None:
+        return pd.read_parquet(
+            parquet_path, engine="pyarrow", columns=columns, filters=filters
+        )
+
+    # CSV can't be filtered while reading, so filter in memory (reading the
+    # filtered columns too)
+    read_columns = _read_columns(columns, filters)
+    if parse_dates is not None and read_columns is not None:
+        parse_dates = [col for col in parse_dates if col in read_columns]
+    df = _read_csv(processed_path(name, "csv"), read_columns, parse_dates)
+    df = _apply_filters(df, filters)
+    return df if columns is None else df[columns]
+
+
+def _read_csv(path, columns, parse_dates):
+    """Read a processed CSV, keeping ID columns as strings (e.g. ZIP codes with leading zeros)."""
+    return pd.read_csv(
+        path, usecols=columns, parse_dates=parse_dates,
+        dtype={col: str for col in CATEGORICAL_COLUMNS}
+    )
+
+
+def _normalize_filters(filters):
+    """Filters as a list of conjunctions (lists of terms), [] for None."""
+    if not filters:
+        return []
+    if isinstance(filters[0], tuple):
+        return [list(filters)]
+    return [list(conjunction) for conjunction in filters]
+
+
+def _read_columns(columns, filters, key=()):
+    """Columns to read for `columns`, plus the key and filtered columns."""
+    if columns is None:
+        return None
+    filter_cols = [term[0] for conjunction in _normalize_filters(filters) for term in conjunction]
+    return list(dict.fromkeys([*key, *columns, *filter_cols]))
+
+
+def _apply_filters(df, filters):
+    """Rows of `df` matching pyarrow-style `filters`, applied in memory."""
+    if not filters:
+        return df
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    return table.filter(pq.filters_to_expression(filters)).to_pandas()
+
+
+class TableWriter:
+    """
+    Writes a processed table chunk by chunk, so it never has to be held in
+    memory at once. Produces the same files as write_table. Use as a context
+    manager:
+
+        with TableWriter("CA_home_price_panel") as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    """
+
+    def __init__(self, name):
+        _clear_partitions(name)
+        self.name = name
+        self.paths = table_paths(name)
+        self.n_rows = 0
+        self._parquet_writer = None
+        self._schema = None
+
+    def _arrow_schema(self, df):
+        # Fix ID columns to dictionary-encoded strings and other text columns
+        # to strings, so chunks with all-missing columns keep the same schema
+        fields = []
+        for field in pa.Schema.from_pandas(df, preserve_index=False):
+            if field.name in CATEGORICAL_COLUMNS and not pd.api.types.is_numeric_dtype(df[field.name]):
+                field = field.with_type(pa.dictionary(pa.int32(), pa.string()))
+            elif df[field.name].dtype == object:
+                field = field.with_type(pa.string())
+            fields.append(field)
+        return pa.schema(fields)
+
+    def write(self, df):
+        for path in self.paths:
+            if path.endswith(".parquet"):
+                if self._parquet_writer is None:
+                    self._schema = self._arrow_schema(df)
+                    self._parquet_writer = pq.ParquetWriter(
+                        path, self._schema, compression=PARQUET_COMPRESSION
+                    )
+                self._parquet_writer.write_table(
+                    pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+                )
+            else:
+                df.to_csv(path, mode="w" if self.n_rows == 0 else "a",
+                          header=self.n_rows == 0, index=False)
+        self.n_rows += len(df)
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# -----------------------------------------------------------------------------
+# Partitions
+# -----------------------------------------------------------------------------
+def _manifest_path(name):
+    return os.path.join(partition_dir(name), "manifest.json")
+
+
+def read_partition_manifest(name):
+    """Partitions appended to table `name`, oldest first ([] if none)."""
+    path = _manifest_path(name)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def _clear_partitions(name):
+    if os.path.isdir(partition_dir(name)):
+        shutil.rmtree(partition_dir(name))
+
+
+def append_partition(df, name, partition, key):
+    """
+    Add `df` to table `name` as a new partition named `partition`, in the
+    same format(s) as the table. Rows replace any earlier rows (in the table
+    or older partitions) with the same values of the `key` columns, so a
+    partition can hold both new rows and corrections to existing ones.
+    Returns the number of partitions.
+    """
+    manifest = read_partition_manifest(name)
+    if any(p["partition"] == partition for p in manifest):
+        raise ValueError(f"Partition {partition!r} already exists for {name}")
+
+    os.makedirs(partition_dir(name), exist_ok=True)
+    paths = [
+        os.path.join(partition_dir(name), f"{partition}{os.path.splitext(path)[1]}")
+        for path in table_paths(name)
+    ]
+    _write_table_files(df, paths)
+
+    # Update the manifest last, so a partial write is never read
+    manifest.append({"partition": partition, "key": list(key), "rows": len(df)})
+    with open(_manifest_path(name), "w") as f:
+        json.dump(manifest, f, indent=1)
+    return len(manifest)
+
+
+def _key_filters(filters, key):
+    """
+    The terms of `filters` on `key` columns, or None if some conjunction has
+    none. Every version of a row has the same key, so these can be applied
+    to each source before older rows are replaced.
+    """
+    key_filters = []
+    for conjunction in _normalize_filters(filters):
+        terms = [term for term in conjunction if term[0] in key]
+        if not terms:
+            return None
+        key_filters.append(terms)
+    return key_filters or None
+
+
+def _read_partitioned_table(name, partitions, columns, filters, parse_dates):
+    """Read a table and its partitions, keeping the latest row for each key."""
+    key = partitions[-1]["key"]
+    # Also read the key and any filtered columns, dropped again at the end
+    read_columns = _read_columns(columns, filters, key)
+    if parse_dates is not None and read_columns is not None:
+        parse_dates = [col for col in parse_dates if col in read_columns]
+
+    # Filters on the key are applied to each source as it is read (pushed down
+    # into Parquet), so e.g. one year of a panel is read without loading the
+    # whole table and its partitions
+    key_filters = _key_filters(filters, key)
+
+    # The table itself, then its partitions in the order they were appended
+    sources = [os.path.join(config.PROCESSED_DATA_DIR, name)]
+    sources += [os.path.join(partition_dir(name), p["partition"]) for p in partitions]
+
+    frames = []
+    for source in sources:
+        if os.path.exists(source + ".parquet") and (
+            config.PROCESSED_FORMAT != "csv" or not os.path.exists(source + ".csv")
+        ):
+            frames.append(pd.read_parquet(
+                source + ".parquet", engine="pyarrow", columns=read_columns, filters=key_filters
+            ))
+        else:
+            frames.append(_apply_filters(
+                _read_csv(source + ".csv", read_columns, parse_dates),
+                key_filters
+            ))
+
+    # Sources with no rows left after filtering would only upset the dtypes
+    df = pd.concat([frame for frame in frames if len(frame)] or frames[:1], ignore_index=True)
+    df = df.drop_duplicates(subset=key, keep="last").sort_values(key, kind="stable")
+
+    # Other filters have to be applied after older rows are replaced, not
+    # pushed down
+    df = _apply_filters(df, filters)
+
+    df = _encode_categoricals(df).reset_index(drop=True)
+    return df if columns is None else df[columns]
+
+
+def compact_table(name):
+    """Fold the partitions of table `name` into a single rewritten table."""
+    if read_partition_manifest(name):
+        write_table(read_table(name), name)
+    return table_paths(name)[0]
+
+
+# -----------------------------------------------------------------------------
+# Geometries
+# -----------------------------------------------------------------------------
+def write_geo_table(gdf, name):
+    """
+    Save a GeoDataFrame as GeoParquet and/or its export format (FlatGeobuf
+    with a spatial index, or GeoJSON) depending on config. The export is
+    written through pyogrio's Arrow path, without building OGR features in
+    Python.
+    """
+    for path in geo_table_paths(name):
+        if path.endswith(".parquet"):
+            _encode_categoricals(gdf).to_parquet(
+                path, compression=PARQUET_COMPRESSION, index=False,
+                write_covering_bbox=True, row_group_size=GEO_ROW_GROUP_SIZE
+            )
+        elif path.endswith(".fgb"):
+            gdf.to_file(path, driver="FlatGeobuf", engine="pyogrio", use_arrow=True,
+                        SPATIAL_INDEX="YES")
+        else:
+            gdf.to_file(path, driver="GeoJSON", engine="pyogrio", use_arrow=True)
+    return geo_table_paths(name)[0]
+
+
+def read_geo_table(name, columns=None, bbox=None):
+    """
+    Load a processed GeoDataFrame from GeoParquet, falling back to the
+    FlatGeobuf or GeoJSON export. If `bbox` (xmin, ymin, xmax, ymax, in the
+    table's CRS) is given, only rows intersecting it are returned, without
+    parsing the rest of the file (from GeoParquet, all rows whose bounds
+    intersect it). FlatGeobuf rows come back in spatial index order rather
+    than the order they were written.
+    """
+    if columns is not None and "geometry" not in columns:
+        columns = [*columns, "geometry"]
+
+    parquet_path = _read_parquet_path(name, config.GEO_EXPORT_FORMAT)
+    if parquet_path is not None:
+        return gpd.read_parquet(parquet_path, columns=columns, bbox=bbox)
+
+    # Configured export format first, then whichever other export exists
+    export_paths = [processed_path(name, ext) for ext in
+                    dict.fromkeys([config.GEO_EXPORT_FORMAT, "fgb", "geojson"])]
+    path = next((p for p in export_paths if os.path.exists(p)), export_paths[0])
+    gdf = gpd.read_file(
+        path, engine="pyogrio", use_arrow=True, bbox=bbox,
+        columns=None if columns is None else [c for c in columns if c != "geometry"]
+    )
+    if columns is not None:
+        gdf = gdf[columns]
+    return gdf
@@ -0,0 +1,78 @@
+"""
+===============================================================================
+ Title: violation_indicators.py
+ Description:
+     Violation indicators from a rule table (config.VIOLATION_INDICATOR_RULES)
+     instead of hard-coded comparisons. Each rule maps a contaminant and/or
+     public notification tier to an indicator, and can exclude matches from
+     it instead. Rules are applied once per violation, before expanding to
+     months, by looking up the violation's contaminant and tier category
+     codes in a small table of bitmask flags (one bit per indicator), so
+     the cost barely depends on the number of indicators. Flags are OR-ed
+     across violations and unpacked into int8 columns only at the end.
+
+     Rule format:
+         {"indicator": "nitrate", "contaminant": "Nitrate"}
+         {"indicator": "tier1_all", "tier": 1}
+         {"indicator": "tier1_other", "contaminant": "Nitrate", "exclude": True}
+===============================================================================
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# Indicators are bits of a uint64 flag
+MAX_INDICATORS = 64
+
+
+def indicator_names(rules):
+    """Indicator names in the order they first appear in `rules`."""
+    return list(dict.fromkeys(rule["indicator"] for rule in rules))
+
+
+def _rule_positions(categories, value):
+    """Lookup table rows (or columns) a rule value applies to."""
+    if value is None:
+        # Any value, including missing ones (the extra last position)
+        return np.arange(len(categories) + 1)
+    positions = categories.get_indexer([value])
+    return positions[positions >= 0]
+
+
+def violation_flags(violations, rules, contaminant_col="Contaminant Name",
+                    tier_col="Public Notification Tier"):
+    """
+    uint64 indicator flags for each violation: bit i is set if the violation
+    matches an including rule for indicator i (see indicator_names) and no
+    excluding rule for it. A rule without "contaminant" or "tier" matches
+    any value of that field.
+    """
+    names = indicator_names(rules)
+    if len(names) > MAX_INDICATORS:
+        raise ValueError(f"At most {MAX_INDICATORS} indicators are supported, got {len(names)}")
+
+    contaminants = pd.Categorical(violations[contaminant_col])
+    tiers = pd.Categorical(violations[tier_col])
+
+    # Flags by (contaminant code, tier code). The extra last row / column
+    # holds missing values, which have code -1 and so index it directly
+    shape = (len(contaminants.categories) + 1, len(tiers.categories) + 1)
+    include = np.zeros(shape, dtype=np.uint64)
+    exclude = np.zeros(shape, dtype=np.uint64)
+    for rule in rules:
+        bit = np.uint64(1) << np.uint64(names.index(rule["indicator"]))
+        rows = _rule_positions(contaminants.categories, rule.get("contaminant"))
+        cols = _rule_positions(tiers.categories, rule.get("tier"))
+        table = exclude if rule.get("exclude", False) else include
+        table[np.ix_(rows, cols)] |= bit
+
+    flags = include & ~exclude
+    return flags[contaminants.codes, tiers.codes]
+
+
+def unpack_flags(flags, names):
+    """DataFrame with one int8 column per indicator from uint64 `flags`."""
+    flags = np.asarray(flags, dtype=np.uint64)
+    bits = (flags[:, None] >> np.arange(len(names), dtype=np.uint64)) & np.uint64(1)
+    return pd.DataFrame(bits.astype(np.int8), columns=names)
@@ -0,0 +1,183 @@
+"""
+===============================================================================
+ Title: zillow_reshape.py
+ Description:
+     Streams the Zillow ZHVI zip-code file (one row per zip, one column per
+     month) into the long home price panel. The file is read in chunks of
+     rows, each chunk is filtered by state and reshaped to long format, and
+     the result is appended straight to the output, so peak memory is
+     bounded by one chunk regardless of how many states are kept. When a
+     new release only adds months, read_zhvi_delta reshapes just the new
+     month columns (and the full history of zips not seen before). Zips
+     are keyed with a ZCTA key dictionary loaded once per file.
+===============================================================================
+"""
+
+import re
+import numpy as np
+import pandas as pd
+
+from storage import TableWriter
+from panel_diagnostics import wide_panel_diagnostics
+from instrumentation import Progress
+from keys import normalize_zip, zcta_keys
+
+
+# ID columns kept from the ZHVI file and their names in the panel
+ZHVI_ID_COLUMNS = {
+    "RegionName": "zip_code",
+    "City": "city",
+    "Metro": "metro",
+    "CountyName": "county_name",
+}
+
+# ID columns are read as text: a chunk where City or Metro is all missing
+# would otherwise be read as float64, which the panel's schema can't take
+ZHVI_ID_DTYPES = {col: str for col in [*ZHVI_ID_COLUMNS, "State"]}
+
+PANEL_COLUMNS = [
+    "zip_code", "zcta_key", "city", "metro", "county_name", "date", "avg_home_price",
+    "year", "month"
+]
+
+
+def home_price_panel_name(states):
+    """Processed dataset name for the panel covering `states` (None = all)."""
+    if states is None:
+        return "US_home_price_panel"
+    return "-".join(states) + "_home_price_panel"
+
+
+def zhvi_date_columns(columns):
+    """Month columns in the ZHVI header (those beginning with digits)."""
+    return [c for c in columns if re.match(r'^\d', c)]
+
+
+def reshape_zhvi_chunk(chunk, date_cols, dates, keep_state=False, keys=None):
+    """
+    Reshape one block of wide ZHVI rows to the long panel layout.
+
+    `dates` are the already-parsed datetimes of `date_cols`, so header
+    strings are converted once per file rather than once per row. Rows are
+    ordered month by month, as DataFrame.melt would order them. Zip codes
+    are normalized to 5-character strings and, if a ZCTA KeyDictionary
+    `keys` is given, keyed once per zip (adding new zips to it). Without
+    `keys` the zcta_key column is left out and nothing is written.
+    """
+    n_zips, n_months = len(chunk), len(date_cols)
+
+    id_cols = {**ZHVI_ID_COLUMNS, **({"State": "state"} if keep_state else {})}
+    ids = {new: chunk[old].to_numpy() for old, new in id_cols.items()}
+    ids["zip_code"] = normalize_zip(ids["zip_code"])
+    if keys is not None:
+        ids["zcta_key"] = keys.encode(ids["zip_code"])
+    long = pd.DataFrame({new: np.tile(values, n_months) for new, values in ids.items()})
+    long["date"] = np.repeat(dates.to_numpy(), n_zips)
+    long["avg_home_price"] = chunk[date_cols].to_numpy().ravel(order="F")
+    long["year"] = long["date"].dt.year
+    long["month"] = long["date"].dt.month
+
+    columns = PANEL_COLUMNS + (["state"] if keep_state else [])
+    return long[[col for col in columns if col in long.columns]]
+
+
+def _read_zhvi_chunks(zillow_file, states, chunksize):
+    """Yield (wide chunk, date columns, parsed dates) for zips in `states`."""
+    header = pd.read_csv(zillow_file, nrows=0).columns
+    date_cols = zhvi_date_columns(header)
+    dates = pd.to_datetime(pd.Index(date_cols), format="%Y-%m-%d", errors="coerce")
+
+    reader = pd.read_csv(
+        zillow_file,
+        usecols=[*ZHVI_ID_COLUMNS, "State", *date_cols],
+        dtype={**ZHVI_ID_DTYPES, **{c: "float64" for c in date_cols}},
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        if states is not None:
+            chunk = chunk[chunk["State"].isin(states)]
+        if len(chunk):
+            yield chunk, date_cols, dates
+
+
+def stream_zhvi_panel(zillow_file, states=("CA",), chunksize=2000, keys=None):
+    """
+    Read the ZHVI file in chunks of `chunksize` zips and yield the long panel
+    for zips in `states` (all states if None), one chunk at a time. Zips are
+    keyed with `keys` if given (see reshape_zhvi_chunk).
+    """
+    keep_state = states is None or len(states) > 1
+    for chunk, date_cols, dates in _read_zhvi_chunks(zillow_file, states, chunksize):
+        yield reshape_zhvi_chunk(chunk, date_cols, dates, keep_state, keys)
+
+
+def write_zhvi_panel(zillow_file, states=("CA",), chunksize=2000):
+    """
+    Stream the long ZHVI panel for `states` directly to processed data.
+    Returns the output path, the number of panel rows written and the
+    per-zip coverage summary (see panel_diagnostics), computed chunk by chunk
+    on the wide values.
+    """
+    keep_state = states is None or len(states) > 1
+    keys = zcta_keys()
+    summaries = []
+    progress = Progress(None, "ZHVI panel rows written")
+    with TableWriter(home_price_panel_name(states)) as writer:
+        for chunk, date_cols, dates in _read_zhvi_chunks(zillow_file, states, chunksize):
+            long_chunk = reshape_zhvi_chunk(chunk, date_cols, dates, keep_state, keys)
+            writer.write(long_chunk)
+            progress.update(len(long_chunk))
+            summaries.append(wide_panel_diagnostics(
+                chunk[date_cols], normalize_zip(chunk["RegionName"]), dates, "zip_code"
+            ))
+    summary = pd.concat(summaries, ignore_index=True) if summaries else None
+    return writer.paths[0], writer.n_rows, summary
+
+
+def read_zhvi_delta(zillow_file, states, known_dates, known_zips):
+    """
+    Long panel rows in a new ZHVI release that are not in an existing panel
+    covering `known_dates` and `known_zips`: every zip's values for months
+    not in `known_dates`, plus all months for zips not in `known_zips`. Only
+    the ID columns and the needed month columns are parsed. Revisions to
+    values of already known months are not picked up.
+
+    Returns (delta, new_dates, new_zips, dropped_zips), where dropped_zips
+    are known zips missing from the release (a full rebuild would drop them).
+    """
+    header = pd.read_csv(zillow_file, nrows=0).columns
+    date_cols = zhvi_date_columns(header)
+    dates = pd.to_datetime(pd.Index(date_cols), format="%Y-%m-%d", errors="coerce")
+    is_new = ~dates.isin(pd.DatetimeIndex(known_dates))
+    keep_state = states is None or len(states) > 1
+    keys = zcta_keys()
+
+    def read_months(month_cols):
+        wide = pd.read_csv(
+            zillow_file,
+            usecols=[*ZHVI_ID_COLUMNS, "State", *month_cols],
+            dtype={**ZHVI_ID_DTYPES, **{c: "float64" for c in month_cols}},
+        )
+        if states is not None:
+            wide = wide[wide["State"].isin(states)]
+        return wide
+
+    new_cols = [c for c, new in zip(date_cols, is_new) if new]
+    wide = read_months(new_cols)
+    zips = normalize_zip(wide["RegionName"]).astype(str)
+    known_zips = normalize_zip(known_zips).astype(str)
+    new_zips = np.setdiff1d(zips, known_zips)
+    dropped_zips = np.setdiff1d(known_zips, zips)
+
+    parts = [reshape_zhvi_chunk(wide, new_cols, dates[is_new], keep_state, keys)] if new_cols else []
+
+    # Zips added in this release also need their history for known months
+    if len(new_zips):
+        old_cols = [c for c, new in zip(date_cols, is_new) if not new]
+        history = read_months(old_cols)
+        history = history[np.isin(normalize_zip(history["RegionName"]).astype(str), new_zips)]
+        parts.append(reshape_zhvi_chunk(history, old_cols, dates[~is_new], keep_state, keys))
+
+    columns = PANEL_COLUMNS + (["state"] if keep_state else [])
+    delta = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=columns)
+    return delta, dates[is_new], new_zips, dropped_zips